@@ -0,0 +1,359 @@
+import re
+from datetime import date
+
+import numpy as np
+from sqlalchemy import String, and_, case, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from extensions import db
+from forecasting import MAX_HORIZON, spend_forecast
+from price_comparison import MAX_TOP_PRODUCTS, price_comparison, price_gaps
+from product_analytics import abc_analysis, product_lifecycle, product_performance, substitution_opportunities
+from volatility import MAX_WINDOW_DAYS, volatility_report
+
+
+class invoice_month(FunctionElement):
+    """'YYYY-MM' bucket of a DATE expression"""
+    type = String()
+    name = 'invoice_month'
+    inherit_cache = True
+
+
+@compiles(invoice_month, 'postgresql')
+def _invoice_month_postgresql(element, compiler, **kw):
+    return "to_char(%s, 'YYYY-MM')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(invoice_month, 'sqlite')
+def _invoice_month_sqlite(element, compiler, **kw):
+    return "substr(%s, 1, 7)" % compiler.process(element.clauses, **kw)
+
+
+def parse_filters(args):
+    """Read store/start/end query params; dates are inclusive ISO YYYY-MM-DD.
+
+    Also reads the volatility options window (days, default 30), z (spike
+    threshold, default 2) and spikes_only, the forecast horizon (months,
+    default 3), and for price comparisons product (a product code),
+    trailing_days (default 90) and top (default 20).
+    """
+    start = args.get('start')
+    end = args.get('end')
+    filters = {
+        'store': args.get('store', 'all'),
+        'start': date.fromisoformat(start) if start else None,
+        'end': date.fromisoformat(end) if end else None,
+        'window': int(args.get('window', 30)),
+        'z': float(args.get('z', 2)),
+        'spikes_only': args.get('spikes_only', '').lower() in ('1', 'true', 'yes'),
+        'horizon': int(args.get('horizon', 3)),
+        'product': args.get('product') or None,
+        'trailing_days': int(args.get('trailing_days', 90)),
+        'top': int(args.get('top', 20)),
+    }
+    if filters['start'] and filters['end'] and filters['start'] > filters['end']:
+        raise ValueError('start must be on or before end')
+    if not 0 <= filters['window'] <= MAX_WINDOW_DAYS:
+        raise ValueError(f'window must be between 0 and {MAX_WINDOW_DAYS} days')
+    if not 0 < filters['horizon'] <= MAX_HORIZON:
+        raise ValueError(f'horizon must be between 1 and {MAX_HORIZON}')
+    if filters['trailing_days'] < 1:
+        raise ValueError('trailing_days must be at least 1')
+    if not 0 < filters['top'] <= MAX_TOP_PRODUCTS:
+        raise ValueError(f'top must be between 1 and {MAX_TOP_PRODUCTS}')
+    return filters
+
+
+def _columns():
+    """Expressions shared by the reports, mirroring the browser's parsed fields.
+
+    Descriptive fields come from the dimension tables, so statements using
+    them go through _where(), which adds the joins.
+    """
+    from dimensions import dimension_columns
+    from models import InvoiceRecord as R
+
+    d = dimension_columns()
+    return {
+        'day': R.invoice_date,
+        'month': invoice_month(R.invoice_date),
+        'category': func.coalesce(func.nullif(func.trim(d['category']), ''), 'Unknown'),
+        'vendor': func.coalesce(d['vendor'], 'Unknown'),
+        'brand': func.coalesce(func.nullif(d['brand'], ''), 'Generic'),
+        'pack_size': func.coalesce(d['pack_size'], 'Unknown'),
+        'product': d['product_description'],
+        # Unit price falls back to ext / qty when missing, like loadInvoiceData
+        'unit_price': case(
+            (R.unit_price > 0, R.unit_price),
+            (R.quantity > 0, R.extended_price / R.quantity),
+            else_=0.0,
+        ),
+        'ext_price': func.coalesce(R.extended_price, 0.0),
+        'qty': func.coalesce(R.quantity, 0.0),
+    }
+
+
+def _where(stmt, user_id, filters):
+    from dimensions import join_dimensions
+    from models import InvoiceRecord as R
+
+    stmt = join_dimensions(stmt).where(R.user_id == user_id)
+    if filters['store'] != 'all':
+        stmt = stmt.where(R.store_id == filters['store'])
+    if filters['start']:
+        stmt = stmt.where(R.invoice_date >= filters['start'])
+    if filters['end']:
+        stmt = stmt.where(R.invoice_date <= filters['end'])
+    return stmt
+
+
+def category_monthly_spend(user_id, filters):
+    """[{'month', 'category', 'spend', 'avg_price', 'count'}] ordered by month.
+
+    Read from the rollup tables: the monthly grain when the whole history is
+    requested, the daily grain when a date range cuts through months.
+    """
+    from models import DailyRollup, MonthlyRollup
+
+    if filters['start'] or filters['end']:
+        t = DailyRollup
+        month = invoice_month(t.day)
+    else:
+        t = MonthlyRollup
+        month = t.month
+    stmt = select(
+        month.label('month'),
+        t.category.label('category'),
+        func.sum(t.total_spend).label('spend'),
+        (func.sum(t.unit_price_sum) / func.sum(t.line_count)).label('avg_price'),
+        func.sum(t.line_count).label('count'),
+    ).where(t.user_id == user_id)
+    if filters['store'] != 'all':
+        stmt = stmt.where(t.store_id == filters['store'])
+    if filters['start']:
+        stmt = stmt.where(t.day >= filters['start'])
+    if filters['end']:
+        stmt = stmt.where(t.day <= filters['end'])
+    stmt = stmt.group_by(month, t.category).order_by(month, t.category)
+    return [row._asdict() for row in db.session.execute(stmt)]
+
+
+def budget_variance(user_id, filters):
+    """Category actual vs projected spend, matching calculateBudgetVariance"""
+    monthly = {}
+    actual = {}
+    for row in category_monthly_spend(user_id, filters):
+        monthly.setdefault(row['month'], {})[row['category']] = row['spend']
+        actual[row['category']] = actual.get(row['category'], 0.0) + row['spend']
+
+    months = sorted(monthly)
+    last3 = months[-3:]
+    variance = {}
+    for category, spend in actual.items():
+        avg_monthly = sum(monthly[m].get(category, 0.0) for m in last3) / max(len(last3), 1)
+        projected = avg_monthly * len(months) or spend
+        variance[category] = {
+            'actual': spend,
+            'projected': projected,
+            'variance': spend - projected,
+            'variancePercent': (spend - projected) / projected * 100 if projected > 0 else 0,
+        }
+    return variance
+
+
+def supply_concentration(user_id, filters):
+    """Vendor spend shares, HHI and top-N concentration, matching analyzeSupplyConcentration"""
+    from snapshots import regroup, user_snapshot
+
+    snapshot = user_snapshot(user_id)
+    rows = np.flatnonzero(snapshot.mask(filters))
+    codes, names = regroup(snapshot.vendor[rows], [v or 'Unknown' for v in snapshot.labels['vendor']])
+    spend = np.bincount(codes, weights=snapshot.ext_price[rows], minlength=len(names))
+    # Distinct invoice numbers per vendor, not counting missing ones
+    invoices = snapshot.invoice[rows].astype(np.int64)
+    numbered = np.array([n is not None for n in snapshot.labels['invoice']], dtype=bool)[invoices]
+    pairs = np.unique(codes[numbered] * len(snapshot.labels['invoice']) + invoices[numbered])
+    order_counts = np.bincount(pairs // max(len(snapshot.labels['invoice']), 1), minlength=len(names))
+
+    present = np.unique(codes).tolist()
+    total_spend = float(spend.sum())
+    vendors = sorted((
+        {
+            'vendor': names[code],
+            'spend': float(spend[code]),
+            'orderCount': int(order_counts[code]),
+            'sharePercent': float(spend[code]) / total_spend * 100 if total_spend else 0,
+        } for code in present
+    ), key=lambda v: v['spend'], reverse=True)
+
+    hhi = sum(v['sharePercent'] ** 2 for v in vendors)
+    return {
+        'vendors': vendors,
+        'totalVendors': len(vendors),
+        'hhi': hhi,
+        'top5Share': sum(v['sharePercent'] for v in vendors[:5]),
+        'top10Share': sum(v['sharePercent'] for v in vendors[:10]),
+        'concentrationRisk': 'High' if hhi > 2500 else 'Moderate' if hhi > 1500 else 'Low',
+    }
+
+
+def forecast_data(user_id, filters):
+    """Monthly spend time series with category breakdown, matching prepareForecastData"""
+    months = {}
+    for row in category_monthly_spend(user_id, filters):
+        month = months.setdefault(row['month'], {'spend': 0.0, 'price_sum': 0.0, 'count': 0, 'categories': []})
+        month['spend'] += row['spend']
+        month['price_sum'] += row['avg_price'] * row['count']
+        month['count'] += row['count']
+        month['categories'].append({
+            'category': row['category'],
+            'spend': row['spend'],
+            'avgPrice': row['avg_price'],
+        })
+
+    return [{
+        'ds': f'{month}-01',
+        'y': totals['spend'],
+        'avgPrice': totals['price_sum'] / totals['count'],
+        'categories': totals['categories'],
+    } for month, totals in sorted(months.items())]
+
+
+def brand_rollup(user_id, filters):
+    """Per-brand spend, share, loyalty, competitiveness and switching, matching analyzeBrands"""
+    from models import InvoiceRecord as R
+
+    c = _columns()
+    rows = db.session.execute(_where(select(
+        c['brand'].label('brand'),
+        func.sum(c['ext_price']).label('totalSpend'),
+        func.sum(c['qty']).label('totalQty'),
+        func.count().label('invoiceCount'),
+        func.min(c['unit_price']).label('minPrice'),
+        func.max(c['unit_price']).label('maxPrice'),
+        func.count(func.distinct(c['product'])).label('productCount'),
+        func.count(func.distinct(R.category_id)).label('categoryCount'),
+        func.count(func.distinct(R.vendor_id)).label('vendorCount'),
+        func.count(func.distinct(c['day'])).label('purchaseDays'),
+    ), user_id, filters).group_by(c['brand'])).all()
+
+    # Competitiveness: brand's average price per category relative to the category average
+    category_avg = dict(db.session.execute(_where(select(
+        c['category'], func.avg(c['unit_price'])
+    ), user_id, filters).group_by(c['category'])).all())
+    ratios = {}
+    for brand, category, avg_price in db.session.execute(_where(select(
+        c['brand'], c['category'], func.avg(c['unit_price'])
+    ), user_id, filters).group_by(c['brand'], c['category'])):
+        if (category_avg.get(category) or 0) > 0:
+            ratios.setdefault(brand, []).append(avg_price / category_avg[category] * 100)
+
+    # Switching: consecutive purchases of the same product under a different brand
+    previous = func.lag(c['brand']).over(partition_by=c['product'], order_by=(c['day'], R.id))
+    sequence = _where(select(
+        previous.label('from_brand'), c['brand'].label('to_brand')
+    ), user_id, filters).subquery()
+    switches = {}
+    for from_brand, to_brand, count in db.session.execute(
+        select(sequence.c.from_brand, sequence.c.to_brand, func.count())
+        .where(and_(sequence.c.from_brand.is_not(None), sequence.c.from_brand != sequence.c.to_brand))
+        .group_by(sequence.c.from_brand, sequence.c.to_brand)
+    ):
+        switches.setdefault(from_brand, []).append({'fromBrand': from_brand, 'toBrand': to_brand, 'count': count})
+
+    total_spend = sum(r.totalSpend for r in rows)
+    brands = {}
+    for r in rows:
+        patterns = sorted(switches.get(r.brand, []), key=lambda p: p['count'], reverse=True)
+        total_switches = sum(p['count'] for p in patterns)
+        for pattern in patterns:
+            pattern['percentage'] = pattern['count'] / total_switches * 100
+        repeat_purchases = r.invoiceCount - r.purchaseDays
+        first_half = r.invoiceCount // 2
+        brands[r.brand] = {
+            'brand': r.brand,
+            'totalSpend': r.totalSpend,
+            'totalQty': r.totalQty,
+            'invoiceCount': r.invoiceCount,
+            'avgPrice': r.totalSpend / r.totalQty if r.totalQty > 0 else 0,
+            'priceRange': {'min': r.minPrice, 'max': r.maxPrice},
+            'priceSpread': r.maxPrice - r.minPrice,
+            'productCount': r.productCount,
+            'categoryCount': r.categoryCount,
+            'vendorCount': r.vendorCount,
+            'marketShare': r.totalSpend / total_spend * 100 if total_spend > 0 else 0,
+            'repeatPurchases': repeat_purchases,
+            'loyaltyRate': repeat_purchases / r.invoiceCount * 100,
+            'competitivenessIndex': (sum(ratios[r.brand]) / len(ratios[r.brand])
+                                     if ratios.get(r.brand) else 100),
+            'switchingPatterns': patterns,
+            'switchingRate': total_switches / r.invoiceCount * 100,
+            'growthTrend': ((r.invoiceCount - 2 * first_half) / first_half * 100
+                            if r.invoiceCount > 3 else 0),
+        }
+    return brands
+
+
+_PACK_QUANTITY = re.compile(r'(\d+)/')
+
+
+def pack_size_rollup(user_id, filters):
+    """Per category and pack size spend and cost per unit, matching analyzePackSizes"""
+    from snapshots import user_snapshot
+
+    snapshot = user_snapshot(user_id)
+    rows = np.flatnonzero(snapshot.mask(filters))
+    n_packs = len(snapshot.labels['pack_size'])
+    groups = snapshot.category[rows].astype(np.int64) * n_packs + snapshot.pack_size[rows]
+    keys, group = np.unique(groups, return_inverse=True)
+    spend = np.bincount(group, weights=snapshot.ext_price[rows], minlength=len(keys))
+    qty = np.bincount(group, weights=snapshot.qty[rows], minlength=len(keys))
+    price_sum = np.bincount(group, weights=snapshot.unit_price[rows], minlength=len(keys))
+    lines = np.bincount(group, minlength=len(keys))
+    # Distinct product descriptions per group, not counting missing ones
+    products = snapshot.product[rows].astype(np.int64)
+    described = np.array([d is not None for d in snapshot.labels['product']], dtype=bool)[products]
+    n_products = len(snapshot.labels['product'])
+    pairs = np.unique(group[described] * n_products + products[described])
+    product_counts = np.bincount(pairs // max(n_products, 1), minlength=len(keys))
+
+    packs = {}
+    for i, key in enumerate(keys.tolist()):
+        category = snapshot.labels['category'][key // n_packs]
+        pack_size = snapshot.labels['pack_size'][key % n_packs]
+        avg_unit_price = float(price_sum[i] / lines[i])
+        match = _PACK_QUANTITY.search(pack_size)
+        pack_qty = int(match.group(1)) if match else 0
+        avg_cost_per_unit = avg_unit_price / pack_qty if pack_qty > 0 else 0
+        packs[f'{category}|{pack_size}'] = {
+            'category': category,
+            'packSize': pack_size,
+            'totalSpend': float(spend[i]),
+            'totalQty': float(qty[i]),
+            'avgUnitPrice': avg_unit_price,
+            'avgCostPerUnit': avg_cost_per_unit,
+            'productCount': int(product_counts[i]),
+            'efficiency': 1 / avg_cost_per_unit if avg_cost_per_unit > 0 else 0,
+        }
+    return packs
+
+
+# /api/analytics/<report> name -> report function(user_id, filters); each
+# function's docstring describes its payload
+REPORTS = {
+    'category-monthly': category_monthly_spend,
+    'budget-variance': budget_variance,
+    'supply-concentration': supply_concentration,
+    'forecast-data': forecast_data,
+    'brands': brand_rollup,
+    'pack-sizes': pack_size_rollup,
+    'volatility': volatility_report,
+    'products': product_performance,
+    'abc': abc_analysis,
+    'product-lifecycle': product_lifecycle,
+    'substitutions': substitution_opportunities,
+    'spend-forecast': spend_forecast,
+    'price-comparison': price_comparison,
+    'price-gaps': price_gaps,
+}
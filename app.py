@@ -1,5 +1,7 @@
+import json
 import os
-from flask import Flask, request, jsonify, send_from_directory, redirect
+import click
+from flask import Flask, Response, request, jsonify, send_from_directory, redirect, stream_with_context
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 from extensions import db, login_manager
@@ -19,16 +21,29 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 from datetime import timedelta
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 app.config['SESSION_COOKIE_HTTPONLY'] = True
+# Only send Set-Cookie when the session actually changes; make_session_permanent
+# touches it once a day so the lifetime still slides for active users
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+SESSION_TOUCH_INTERVAL_SECONDS = 24 * 60 * 60
 # In production (with HTTPS), use Secure + SameSite=None for OAuth in iframe
 # In development (HTTP), use Lax without Secure (browsers reject Secure on HTTP)
 is_production = os.environ.get('REPLIT_DEPLOYMENT') == '1'
 app.config['SESSION_COOKIE_SECURE'] = is_production
 app.config['SESSION_COOKIE_SAMESITE'] = 'None' if is_production else 'Lax'
 
+# Largest request body accepted (uploads included); larger ones get 413
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 256 * 1024 * 1024))
+
 # Initialize extensions
 db.init_app(app)
 login_manager.init_app(app)
 
+# Request timing and SQL counts; registered first so every other hook is measured
+import instrumentation
+instrumentation.init_app(app)
+
+import assets
+
 # Import models after db is initialized
 import models
 
@@ -41,15 +56,24 @@ app.register_blueprint(make_replit_blueprint(), url_prefix="/auth")
 
 @app.before_request
 def make_session_permanent():
+    import time
     from flask import session
-    session.permanent = True
+    if not session.permanent:
+        session.permanent = True
+    now = int(time.time())
+    if now - session.get('_touched_at', 0) > SESSION_TOUCH_INTERVAL_SECONDS:
+        session['_touched_at'] = now
 
 def init_database():
     with app.app_context():
-        db.create_all()
-
+        from migrations import run_migrations
+        from rollups import ensure_rollups
+        from store_matcher import STORE_MATCH_ORDER
         from models import Store
 
+        # Creates missing tables too; runs before seeding so stores has every column
+        run_migrations()
+
         stores_data = [
             {'id': 'trussville', 'name': 'Trussville Store', 'location': 'Trussville', 'patterns': '7270 GADSDEN HWY,GADSDEN HWY'},
             {'id': 'chelsea', 'name': 'Chelsea Store', 'location': 'Chelsea', 'patterns': '50 CHELSEA RD,CHELSEA RD'},
@@ -66,110 +90,151 @@ def init_database():
                     id=store_data['id'],
                     name=store_data['name'],
                     location=store_data['location'],
-                    address_patterns=store_data['patterns']
+                    address_patterns=store_data['patterns'],
+                    priority=STORE_MATCH_ORDER.index(store_data['id'])
                 )
                 db.session.add(store)
 
         db.session.commit()
+
+        ensure_rollups()
         print("Database initialized and stores seeded successfully")
 
+@app.cli.command('migrate')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows converted per transaction')
+def migrate_command(batch_size):
+    """Create missing tables, convert legacy invoice_records columns and create missing indexes"""
+    from migrations import run_migrations
+    from rollups import ensure_rollups
+    run_migrations(batch_size)
+    ensure_rollups()
+
+@app.cli.command('upload-worker')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty instead of polling')
+def upload_worker_command(once):
+    """Process queued uploads in this process (pair with UPLOAD_WORKER=0 on the web tier)"""
+    from upload_jobs import process_jobs, work_forever, worker_name
+    if once:
+        print(f"Processed {process_jobs(worker_name())} upload jobs")
+    else:
+        work_forever(app)
+
+@app.cli.command('rebuild-rollups')
+@click.option('--user', 'user_id', default=None, help='Only rebuild this user id')
+def rebuild_rollups_command(user_id):
+    """Recompute the daily/monthly rollup tables from invoice_records"""
+    from rollups import rebuild
+    rebuild(user_id)
+    db.session.commit()
+    print("Rollup tables rebuilt")
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
-        return send_from_directory('.', 'Index.html')
+        return assets.index_response()
     else:
         return redirect(url_for('replit_auth.login'))
 
-def safe_float(value):
-    """Safely convert a value to float, returning 0.0 if conversion fails"""
-    if value is None:
-        return 0.0
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
-
 @app.route('/api/upload', methods=['POST'])
 @require_login
 def upload_invoice():
-    from models import Store, Upload, InvoiceRecord
-    from sqlalchemy import select, and_
+    """Queue parsed records for one store; poll /api/uploads/<job_id>/status for the result"""
+    from upload_jobs import enqueue_records, ensure_worker
 
     data = request.json
-    store_id = data.get('store_id')
-    filename = data.get('filename')
-    file_size = data.get('file_size')
-    records = data.get('records', [])
-
-    upload = Upload(
-        user_id=current_user.id,
-        store_id=store_id,
-        filename=filename,
-        file_size=file_size,
-        total_records=len(records)
-    )
-    db.session.add(upload)
-    db.session.flush()
-
-    new_records = 0
-    duplicate_records = 0
-
-    for record_data in records:
-        invoice_number = str(record_data.get('Invoice Number')) if record_data.get('Invoice Number') is not None else None
-        invoice_date = record_data.get('Invoice Date')
-        product_code = record_data.get('Product Code')
-
-        existing = db.session.execute(
-            select(InvoiceRecord).where(
-                and_(
-                    InvoiceRecord.user_id == current_user.id,
-                    InvoiceRecord.store_id == store_id,
-                    InvoiceRecord.invoice_number == invoice_number,
-                    InvoiceRecord.invoice_date == invoice_date,
-                    InvoiceRecord.product_code == product_code
-                )
-            )
-        ).first()
-
-        if existing:
-            duplicate_records += 1
-            continue
-
-        record = InvoiceRecord(
-            user_id=current_user.id,
-            upload_id=upload.id,
-            store_id=store_id,
-            invoice_number=invoice_number,
-            invoice_date=invoice_date,
-            customer_name=record_data.get('Customer Name'),
-            address=record_data.get('Address'),
-            city=record_data.get('City'),
-            state=record_data.get('State'),
-            zip_code=record_data.get('Zip'),
-            product_code=product_code,
-            product_description=record_data.get('Product Description'),
-            brand=record_data.get('Brand') or record_data.get('Brand Name'),
-            category=record_data.get('Product Class Description') or record_data.get('Category'),
-            pack_size=record_data.get('Pack Size'),
-            # Convert string values to floats for numeric fields with error handling
-            quantity=safe_float(record_data.get('Qty Shipped') or record_data.get('Quantity')),
-            unit_price=safe_float(record_data.get('Unit Price')),
-            extended_price=safe_float(record_data.get('Ext. Price') or record_data.get('Extended Price')),
-            vendor=record_data.get('Manufacturer Name') or record_data.get('Vendor'),
-            vendor_code=record_data.get('Vendor Code')
-        )
-        db.session.add(record)
-        new_records += 1
+    job = enqueue_records(current_user.id, data.get('store_id'), data.get('filename'),
+                          data.get('file_size'), data.get('records', []))
+    db.session.commit()
+    ensure_worker(app)
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('upload_status', job_id=job.id),
+    }), 202
+
+def _is_gzipped_upload(filename):
+    return (request.headers.get('Content-Encoding', '').lower() == 'gzip'
+            or request.mimetype in ('application/gzip', 'application/x-gzip')
+            or filename.lower().endswith('.gz'))
 
+@app.route('/api/upload/csv', methods=['POST'])
+@require_login
+def upload_invoice_csv():
+    """Queue a raw PFG CSV export (optionally gzip'd) streamed as the request body; 202 with a job id"""
+    from upload_jobs import enqueue_csv, ensure_worker
+
+    filename = request.args.get('filename', 'upload.csv')
+    job = enqueue_csv(current_user.id, request.stream, filename, request.content_length,
+                      gzipped=_is_gzipped_upload(filename))
     db.session.commit()
+    ensure_worker(app)
 
     return jsonify({
         'success': True,
-        'upload_id': upload.id,
-        'new_records': new_records,
-        'duplicate_records': duplicate_records,
-        'message': f'Successfully uploaded {new_records} new records ({duplicate_records} duplicates skipped)'
-    })
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('upload_status', job_id=job.id),
+    }), 202
+
+@app.route('/api/uploads/<int:job_id>/status')
+@require_login
+def upload_status(job_id):
+    """Progress of a queued upload: rows processed, new and duplicate records, errors"""
+    from models import UploadJob
+    from upload_jobs import ensure_worker, job_status
+
+    job = db.session.get(UploadJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify({'error': 'Upload not found'}), 404
+    if job.status in ('queued', 'running'):
+        ensure_worker(app)
+    response = jsonify(job_status(job))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def _own_upload(upload_id):
+    from models import Upload
+
+    upload = db.session.get(Upload, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        return None
+    return upload
+
+@app.route('/api/uploads/<int:upload_id>', methods=['DELETE'])
+@require_login
+def delete_upload(upload_id):
+    """Remove an upload's records and adjust the rollups, in bounded batches"""
+    from ingest import delete_upload as delete_upload_records
+
+    upload = _own_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'success': True, **delete_upload_records(upload)})
+
+@app.route('/api/uploads/<int:upload_id>/replace', methods=['POST'])
+@require_login
+def replace_upload(upload_id):
+    """Queue a corrected CSV (same body as /api/upload/csv) to take an upload's place"""
+    from upload_jobs import enqueue_csv, ensure_worker
+
+    upload = _own_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    filename = request.args.get('filename', upload.filename)
+
+    job = enqueue_csv(current_user.id, request.stream, filename, request.content_length,
+                      gzipped=_is_gzipped_upload(filename), replaces=upload)
+    db.session.commit()
+    ensure_worker(app)
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('upload_status', job_id=job.id),
+    }), 202
 
 @app.route('/api/userinfo')
 def get_user_info():
@@ -219,44 +284,187 @@ def get_stores():
 @app.route('/api/records/<store_id>')
 @require_login
 def get_records(store_id):
-    """Get all invoice records for a specific store"""
-    from models import InvoiceRecord
-    from sqlalchemy import select
-    
-    print(f"Fetching records for user_id={current_user.id}, store_id={store_id}")
+    """Stream a store's (or 'all') records, paged and encoded as described in records.py"""
+    import gzip
+    from records import (MAX_PAGE_SIZE, STREAM_BATCH_SIZE, COLUMNAR_MIMETYPE, resolve_fields,
+                         select_records, iter_json_array, iter_ndjson, build_columnar)
+    from response_cache import data_version, versioned_etag, cached_or_none, cache_response
 
-    if store_id == 'all':
-        stmt = select(InvoiceRecord).where(InvoiceRecord.user_id == current_user.id)
+    try:
+        fields = resolve_fields(request.args.get('fields'))
+        after = request.args.get('after', type=int)
+        limit = request.args.get('limit', type=int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+
+    etag = versioned_etag(current_user.id, data_version(current_user.id, store_id))
+    cached = cached_or_none(etag)
+    if cached is not None:
+        return cached
+
+    headers = {}
+    if limit is None:
+        stmt = select_records(current_user.id, store_id, fields, after=after)
+        rows = db.session.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
     else:
-        stmt = select(InvoiceRecord).where(
-            InvoiceRecord.user_id == current_user.id,
-            InvoiceRecord.store_id == store_id
-        )
-    
-    records = db.session.execute(stmt).scalars().all()
+        # Fetch one extra row to learn whether another page exists
+        stmt = select_records(current_user.id, store_id, fields, after=after, limit=limit + 1)
+        rows = db.session.execute(stmt).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = str(rows[-1][0])
+
+    response_format = request.args.get('format')
+    if response_format == 'columnar' or request.accept_mimetypes.best == COLUMNAR_MIMETYPE:
+        body = json.dumps(build_columnar(rows, fields), separators=(',', ':')).encode('utf-8')
+        response = Response(body, mimetype=COLUMNAR_MIMETYPE, headers=headers)
+        response.vary.add('Accept-Encoding')
+        if 'gzip' in request.accept_encodings:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.headers['Content-Encoding'] = 'gzip'
+        return cache_response(response, etag)
+
+    ndjson = (response_format == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    if ndjson:
+        return cache_response(Response(stream_with_context(iter_ndjson(rows, fields)),
+                                       mimetype='application/x-ndjson', headers=headers), etag)
+    return cache_response(Response(stream_with_context(iter_json_array(rows, fields)),
+                                   mimetype='application/json', headers=headers), etag)
+
+@app.route('/api/records/query', methods=['POST'])
+@require_login
+def query_records():
+    """Page of records matching the dashboard's filterData object (body: records.parse_query)"""
+    from records import STREAM_BATCH_SIZE, parse_query, select_export, query_summary, record_dict
+    from volatility import spike_ids
 
-    print(f"Found {len(records)} records")
+    try:
+        filters, fields, limit, after = parse_query(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    spikes = spike_ids(current_user.id, filters) if filters['spikes_only'] else None
+    stmt = select_export(current_user.id, filters, fields, after=after)
+    if spikes is None:
+        rows = db.session.execute(stmt.limit(limit + 1)).all()
+    else:
+        matching = (row for row in db.session.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+                    if row[0] in spikes)
+        rows = [row for _, row in zip(range(limit + 1), matching)]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+
+    result = {
+        'records': [record_dict(fields, row) for row in rows],
+        'nextCursor': next_cursor,
+    }
+    if after is None:
+        result['summary'] = query_summary(current_user.id, filters, spikes)
+    return jsonify(result)
+
+@app.route('/api/export/<store_id>')
+@require_login
+def export_records(store_id):
+    """Download a store's (or 'all') filtered records as CSV (params: records.parse_export_filters)"""
+    from datetime import date
+    from records import (ANALYTICS_FIELDS, STREAM_BATCH_SIZE, resolve_fields, parse_export_filters,
+                         select_export, iter_csv, with_analytics)
+    from volatility import row_stats
 
-    return jsonify([{
-        'Invoice Number': r.invoice_number,
-        'Invoice Date': r.invoice_date,
-        'Customer Name': r.customer_name,
-        'Address': r.address,
-        'City': r.city,
-        'State': r.state,
-        'Zip': r.zip_code,
-        'Product Code': r.product_code,
-        'Product Description': r.product_description,
-        'Brand': r.brand,
-        'Category': r.category,
-        'Pack Size': r.pack_size,
-        'Quantity': r.quantity,
-        'Unit Price': r.unit_price,
-        'Extended Price': r.extended_price,
-        'Vendor': r.vendor,
-        'Vendor Code': r.vendor_code,
-        'Store ID': r.store_id
-    } for r in records])
+    try:
+        fields = resolve_fields(request.args.get('fields'))
+        filters = parse_export_filters(request.args, store_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    stmt = select_export(current_user.id, filters, fields)
+    rows = db.session.execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+    analytics = request.args.get('analytics', '').lower() in ('1', 'true', 'yes')
+    if filters['spikes_only'] or analytics:
+        stats = row_stats(current_user.id, filters)
+    if filters['spikes_only']:
+        spikes = set(stats[0][stats[5]].tolist())
+        rows = (row for row in rows if row[0] in spikes)
+    if analytics:
+        rows = with_analytics(rows, stats)
+        fields = fields + ANALYTICS_FIELDS
+
+    filename = f"pfg-export-{store_id}-{date.today().isoformat()}.csv"
+    headers = {}
+    if request.args.get('gzip', '').lower() in ('1', 'true', 'yes'):
+        mimetype = 'application/gzip'
+        filename += '.gz'
+        gzipped = True
+    else:
+        mimetype = 'text/csv'
+        gzipped = 'gzip' in request.accept_encodings
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response = Response(stream_with_context(iter_csv(rows, fields, gzipped=gzipped)),
+                        mimetype=mimetype, headers=headers)
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/api/analytics/<report>')
+@require_login
+def get_analytics(report):
+    """One of analytics.REPORTS for the current user, with query params read by analytics.parse_filters"""
+    from datetime import date
+    from analytics import REPORTS, parse_filters
+    from response_cache import data_version, versioned_etag, cached_or_none, cache_response
+
+    if report not in REPORTS:
+        return jsonify({'error': f'Unknown analytics report: {report}'}), 404
+    try:
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Product status and lifecycle are relative to today, so tags also roll over daily
+    version = f"{data_version(current_user.id, filters['store'])}.{date.today():%Y%m%d}"
+    etag = versioned_etag(current_user.id, version)
+    cached = cached_or_none(etag)
+    if cached is not None:
+        return cached
+    try:
+        payload = REPORTS[report](current_user.id, filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return cache_response(jsonify(payload), etag)
+
+@app.route('/metrics')
+def metrics():
+    """Per-route latency histograms and SQL counts (METRICS_TOKEN, or loopback in development)"""
+    if not instrumentation.metrics_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    response = Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/metrics/profiles/<profile_id>')
+def metrics_profile(profile_id):
+    """Sampling profile and statement counts of a request sent with ?profile=1"""
+    if not instrumentation.metrics_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    report = instrumentation.get_profile(profile_id)
+    if report is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return jsonify(report)
+
+@app.route('/assets/<name>')
+def serve_asset(name):
+    """Fingerprinted, precompressed JS/CSS bundles referenced by the rewritten Index.html"""
+    response = assets.asset_response(name)
+    if response is None:
+        return jsonify({'error': 'Asset not found'}), 404
+    return response
 
 @app.route('/<path:path>')
 def serve_static(path):
@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import os
+import re
+import threading
+
+import brotli
+from flask import Response, request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = 'Index.html'
+
+# Bundles never change under a name, so browsers may keep them for a year
+# without revalidating; the page itself is revalidated on every load
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+INDEX_CACHE_CONTROL = 'private, no-cache'
+
+# The page's own deferred scripts and stylesheets, bundled in document order
+_LOCAL_SCRIPT = re.compile(r'[ \t]*<script src="(js/[\w.-]+\.js)" defer></script>\n')
+_LOCAL_STYLESHEET = re.compile(r'[ \t]*<link rel="stylesheet" href="(css/[\w.-]+\.css)">\n')
+
+_lock = threading.Lock()
+_state = {'mtimes': None, 'index': None, 'assets': {}}
+
+
+class Asset:
+    """A body held in memory with its precompressed variants"""
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+                      'br': brotli.compress(body, quality=11)}
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+
+    def response(self, cache_control):
+        """The best variant the client accepts, or 304 when it already has it"""
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in self.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        etag = f'{self.digest}-{encoding}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+def _read(path):
+    with open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read()
+
+
+def _bundle(html, pattern, extension, mimetype, separator, assets):
+    """Replace the tags pattern matches with one tag for a fingerprinted bundle of their files"""
+    matches = list(pattern.finditer(html))
+    if not matches:
+        return html, []
+    paths = [m.group(1) for m in matches]
+    asset = Asset(separator.join(_read(p) for p in paths), mimetype)
+    name = f'app.{asset.digest}.{extension}'
+    assets[name] = asset
+    first = matches[0]
+    tag = first.group(0).replace(first.group(1), f'/assets/{name}')
+    html = html[:first.start()] + tag + pattern.sub('', html[first.end():])
+    return html, paths
+
+
+def _changed():
+    """Whether any file the last build read has changed on disk since"""
+    try:
+        return any(os.stat(os.path.join(ROOT, p)).st_mtime_ns != mtime for p, mtime in _state['mtimes'].items())
+    except OSError:
+        return True
+
+
+def build():
+    """Bundle, fingerprint and precompress the page's JS and CSS, and rewrite Index.html to use them.
+
+    Bundles from earlier builds in this process stay servable, so a page
+    loaded before a file changed still gets the assets it references.
+    """
+    assets = {}
+    html = _read(INDEX_FILE).decode('utf-8')
+    # A separator keeps one file's unterminated last statement from running into the next
+    html, scripts = _bundle(html, _LOCAL_SCRIPT, 'js', 'text/javascript', b'\n;\n', assets)
+    html, stylesheets = _bundle(html, _LOCAL_STYLESHEET, 'css', 'text/css', b'\n', assets)
+    mtimes = {p: os.stat(os.path.join(ROOT, p)).st_mtime_ns for p in [INDEX_FILE, *scripts, *stylesheets]}
+    _state['assets'].update(assets)
+    _state['index'] = Asset(html.encode('utf-8'), 'text/html')
+    _state['mtimes'] = mtimes
+    print(f"Built assets: {', '.join(assets)}")
+
+
+def _current_index():
+    """The rewritten page, rebuilding first if any source file changed on disk"""
+    with _lock:
+        if _state['mtimes'] is None or _changed():
+            build()
+        return _state['index']
+
+
+def index_response():
+    return _current_index().response(INDEX_CACHE_CONTROL)
+
+
+def asset_response(name):
+    """A bundle by fingerprinted name, or None when there is no such bundle"""
+    if _state['mtimes'] is None:
+        _current_index()
+    asset = _state['assets'].get(name)
+    return asset.response(IMMUTABLE_CACHE_CONTROL) if asset is not None else None
@@ -0,0 +1,308 @@
+"""Reproducible API benchmark over synthetic PFG exports.
+
+Runs the Flask app in-process through its test client against a scratch
+database, once per (database, size), each in a fresh subprocess so memory
+peaks and caches do not leak between runs:
+
+    python benchmark.py --rows 10000,100000 --duplicate-rate 0.05
+    python benchmark.py --database-url postgresql://localhost/pfg_bench --output after.json
+    python benchmark.py --rows 100000 --baseline before.json
+
+Reports throughput, p50/p95 latency, peak RSS and SQL statements per endpoint.
+The default database is a temporary SQLite file; a Postgres URL must point at
+a database that is empty or that you pass --reset to wipe.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_ROWS = '10000,100000'
+DEFAULT_REPEAT = 5
+BENCH_USER = 'bench-user'
+
+
+def _log(message):
+    # The app logs with print(), so progress goes to stderr to stay readable
+    print(message, file=sys.stderr, flush=True)
+
+
+def _reset_peak_rss():
+    """Restart the kernel's high-water mark so the next peak is per endpoint (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class Bench:
+    """Times requests through a logged-in test client and counts their SQL"""
+
+    def __init__(self, app, db):
+        from sqlalchemy import event
+
+        self.app = app
+        self.client = app.test_client()
+        self.queries = 0
+        self.results = {}
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def login(self):
+        from extensions import db
+        from models import OAuth, User
+
+        with self.app.app_context():
+            db.session.merge(User(id=BENCH_USER, email='bench@example.com'))
+            db.session.add(OAuth(user_id=BENCH_USER, browser_session_key='bench', provider='replit_auth',
+                                 token={'access_token': 'bench', 'expires_in': 3600}))
+            db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = BENCH_USER
+            session['_fresh'] = True
+            session['_browser_session_key'] = 'bench'
+
+    def measure(self, name, request, rows=None, repeat=1, before=None):
+        """Run request() repeat times; rows is how many records one call handles"""
+        latencies = []
+        queries = []
+        _reset_peak_rss()
+        for _ in range(repeat):
+            if before:
+                before()
+            self.queries = 0
+            started = time.perf_counter()
+            status = request()
+            latencies.append(time.perf_counter() - started)
+            queries.append(self.queries)
+            if status >= 400:
+                raise RuntimeError(f'{name}: HTTP {status}')
+        p50 = _percentile(latencies, 50)
+        result = {
+            'requests': repeat,
+            'p50_ms': round(p50 * 1000, 2),
+            'p95_ms': round(_percentile(latencies, 95) * 1000, 2),
+            'requests_per_s': round(1 / statistics.mean(latencies), 2),
+            'rows_per_s': round(rows / p50) if rows else None,
+            'queries': max(queries),
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+        }
+        self.results[name] = result
+        _log(f"  {name:<28} p50 {result['p50_ms']:>10.2f} ms  p95 {result['p95_ms']:>10.2f} ms  "
+             f"{result['queries']:>6} queries  {result['peak_rss_mb']:>8.1f} MB"
+             + (f"  {result['rows_per_s']:>10} rows/s" if rows else ''))
+        return result
+
+    def get(self, path, **kwargs):
+        def request():
+            response = self.client.get(path, **kwargs)
+            response.get_data()
+            return response.status_code
+        return request
+
+    def post(self, path, **kwargs):
+        def request():
+            response = self.client.post(path, **kwargs)
+            response.get_data()
+            return response.status_code
+        return request
+
+
+def _clear_caches():
+    """Drop every per-process result cache so reads hit the database"""
+    import forecasting
+    import product_analytics
+    import snapshots
+    from response_cache import response_cache
+
+    with response_cache._lock:
+        response_cache._entries.clear()
+        response_cache.size = 0
+    product_analytics._cache.clear()
+    forecasting._fits.clear()
+    # Snapshots on disk stay: reopening them is what another worker would do
+    snapshots._open.clear()
+
+
+def run_one(args):
+    """Benchmark one database at one size (runs inside the worker subprocess)"""
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('SESSION_SECRET', 'benchmark')
+    os.environ.setdefault('REPL_ID', 'benchmark')
+    os.environ['UPLOAD_WORKER'] = '0'
+
+    import synthetic
+    from app import app, init_database
+    from extensions import db
+    from sqlalchemy import inspect, text
+
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+        has_data = 'invoice_records' in tables and db.session.execute(
+            text('SELECT 1 FROM invoice_records LIMIT 1')).first()
+        if has_data and not args.reset:
+            sys.exit(f'{args.database_url} already has invoice records; pass --reset to wipe it')
+        db.drop_all()
+    init_database()
+
+    import upload_jobs
+
+    bench = Bench(app, db)
+    bench.login()
+    started = time.perf_counter()
+    body = synthetic.export_csv(args.rows, args.duplicate_rate, args.seed)
+    _log(f"  generated {args.rows} rows ({len(body) / 1e6:.1f} MB) in {time.perf_counter() - started:.1f}s")
+
+    def upload_and_process():
+        response = bench.client.post('/api/upload/csv?filename=bench.csv', data=body,
+                                     content_type='text/csv')
+        with app.app_context():
+            upload_jobs.process_jobs('benchmark')
+        return response.status_code
+
+    bench.measure('upload_csv', upload_and_process, rows=args.rows)
+    bench.measure('upload_csv (all duplicates)', upload_and_process, rows=args.rows)
+
+    records = list(synthetic.generate_rows(1000, 0, args.seed + 1))
+
+    def upload_records():
+        response = bench.client.post('/api/upload', json={
+            'store_id': 'chelsea', 'filename': 'bench.json', 'file_size': 0, 'records': records,
+        })
+        with app.app_context():
+            upload_jobs.process_jobs('benchmark')
+        return response.status_code
+
+    bench.measure('upload_invoice (1000)', upload_records, rows=len(records))
+
+    repeat = args.repeat
+    gets = [
+        ('get_records json', '/api/records/all', {}),
+        ('get_records ndjson', '/api/records/all?format=ndjson', {}),
+        ('get_records columnar', '/api/records/all?format=columnar', {'headers': {'Accept-Encoding': 'gzip'}}),
+        ('get_records page', '/api/records/all?limit=1000', {}),
+        ('analytics category-monthly', '/api/analytics/category-monthly', {}),
+        ('analytics volatility', '/api/analytics/volatility', {}),
+        ('analytics products', '/api/analytics/products', {}),
+        ('analytics spend-forecast', '/api/analytics/spend-forecast', {}),
+        ('export csv', '/api/export/all', {}),
+    ]
+    with app.app_context():
+        from sqlalchemy import func, select
+        from models import InvoiceRecord
+        stored = db.session.execute(select(func.count()).select_from(InvoiceRecord)).scalar()
+    for name, path, kwargs in gets:
+        rows = 1000 if 'page' in name else stored if name.startswith(('get_records', 'export')) else None
+        bench.measure(name, bench.get(path, **kwargs), rows=rows, repeat=repeat, before=_clear_caches)
+
+    etag = bench.client.get('/api/records/all').headers['ETag']
+    bench.measure('get_records revalidate', bench.get('/api/records/all', headers={'If-None-Match': etag}),
+                  repeat=repeat)
+    bench.measure('records query', bench.post('/api/records/query', json={
+        'filters': {'category': 'DAIRY PROD & SUBS', 'minPrice': 10}, 'limit': 500,
+    }), repeat=repeat)
+
+    return {
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        'rows': args.rows,
+        'stored_rows': stored,
+        'duplicate_rate': args.duplicate_rate,
+        'seed': args.seed,
+        'endpoints': bench.results,
+    }
+
+
+def _compare(results, baseline):
+    """Print p50 changes against a previous --output file"""
+    previous = {(r['database'], r['rows']): r for r in baseline}
+    for run in results:
+        base = previous.get((run['database'], run['rows']))
+        if base is None:
+            continue
+        print(f"\n{run['database']} {run['rows']} rows vs baseline (p50)")
+        for name, result in run['endpoints'].items():
+            before = base['endpoints'].get(name)
+            if before and before['p50_ms']:
+                change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100
+                print(f"  {name:<28} {before['p50_ms']:>10.2f} -> {result['p50_ms']:>10.2f} ms  ({change:+.1f}%)  "
+                      f"queries {before['queries']} -> {result['queries']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', default=DEFAULT_ROWS, help='comma-separated sizes, e.g. 10000,100000,1000000')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='share of rows repeating an earlier row')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed calls per read endpoint')
+    parser.add_argument('--database-url', action='append',
+                        help='database to run against (repeatable); default a temporary SQLite file')
+    parser.add_argument('--reset', action='store_true', help='allow wiping a database that already has records')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON from an earlier --output to compare against')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.rows = int(args.rows)
+        args.database_url = args.database_url[0]
+        result = run_one(args)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for database_url in args.database_url or [None]:
+            for rows in [int(r) for r in args.rows.split(',')]:
+                url = database_url or f"sqlite:///{os.path.join(scratch, f'bench-{rows}.db')}"
+                _log(f"\n{url.split('@')[-1]}: {rows} rows, {args.duplicate_rate:.0%} duplicates")
+                result_file = os.path.join(scratch, f'result-{len(results)}.json')
+                command = [sys.executable, os.path.abspath(__file__), '--worker', '--rows', str(rows),
+                           '--duplicate-rate', str(args.duplicate_rate), '--seed', str(args.seed),
+                           '--repeat', str(args.repeat), '--database-url', url, '--result-file', result_file]
+                if args.reset:
+                    command.append('--reset')
+                completed = subprocess.run(command, stdout=subprocess.DEVNULL,
+                                           cwd=os.path.dirname(os.path.abspath(__file__)))
+                if completed.returncode != 0:
+                    sys.exit(f'benchmark run failed for {url}')
+                with open(result_file) as f:
+                    results.append(json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            _compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+from sqlalchemy import event, func, select, tuple_
+from sqlalchemy.orm import Session
+
+from extensions import db
+
+# invoice_records foreign key -> (dimension model, natural key columns, row fields
+# that supply them). Single-column dimensions map a missing value to a NULL id;
+# composite ones store missing parts as '' so the unique key never holds NULLs.
+DIMENSIONS = {
+    'brand_id': ('Brand', ('name',), ('brand',)),
+    'category_id': ('Category', ('name',), ('category',)),
+    'vendor_id': ('Vendor', ('name', 'code'), ('vendor', 'vendor_code')),
+    'product_id': ('Product', ('code', 'description', 'pack_size'),
+                   ('product_code', 'product_description', 'pack_size')),
+}
+
+# Row fields that live only in the dimensions. product_code also stays on the
+# fact row, where it is part of the dedup key.
+DIMENSION_FIELDS = tuple(f for _, _, fields in DIMENSIONS.values() for f in fields if f != 'product_code')
+
+# Natural key -> id per dimension. Dimension rows are never deleted, so entries
+# stay valid for the life of the process; they are only added once committed.
+_ids = {column: {} for column in DIMENSIONS}
+
+
+def _model(name):
+    import models
+    return getattr(models, name)
+
+
+def _key(row, fields):
+    values = [row.get(f) for f in fields]
+    if all(v is None for v in values):
+        return None
+    if len(values) == 1:
+        return (str(values[0]),)
+    return tuple('' if v is None else str(v) for v in values)
+
+
+def _pending():
+    """Ids resolved in the current transaction, merged into _ids on commit"""
+    return db.session.info.setdefault('pending_dimensions', {column: {} for column in DIMENSIONS})
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    pending = session.info.pop('pending_dimensions', None)
+    if pending:
+        for column, ids in pending.items():
+            _ids[column].update(ids)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('pending_dimensions', None)
+
+
+def _resolve(column, keys):
+    """Ids for natural keys, inserting the dimension rows that do not exist yet"""
+    from ingest import dialect_insert
+
+    model_name, key_columns, _ = DIMENSIONS[column]
+    model = _model(model_name)
+    cached = _ids[column]
+    pending = _pending()[column]
+    missing = [k for k in keys if k not in cached and k not in pending]
+    if missing:
+        db.session.execute(
+            dialect_insert(model.__table__).on_conflict_do_nothing(),
+            [dict(zip(key_columns, k)) for k in missing],
+        )
+        columns = [getattr(model, c) for c in key_columns]
+        match = columns[0].in_([k[0] for k in missing]) if len(columns) == 1 else tuple_(*columns).in_(missing)
+        for row in db.session.execute(select(model.id, *columns).where(match)):
+            pending[tuple(row[1:])] = row[0]
+    return {k: cached.get(k) or pending[k] for k in keys}
+
+
+def resolve_dimensions(rows):
+    """Replace rows' descriptive text fields with dimension ids, in place.
+
+    Keys already seen by this process come from the in-memory cache; the rest
+    are inserted (skipping ones another writer created) and looked up with one
+    query per dimension for the whole batch.
+    """
+    for column, (_, _, fields) in DIMENSIONS.items():
+        keys = [_key(row, fields) for row in rows]
+        ids = _resolve(column, {k for k in keys if k is not None})
+        for row, key in zip(rows, keys):
+            row[column] = ids[key] if key is not None else None
+    for row in rows:
+        for field in DIMENSION_FIELDS:
+            row.pop(field, None)
+    return rows
+
+
+def dimension_columns():
+    """The fields folded into dimensions, as expressions over join_dimensions()"""
+    Brand, Category, Product, Vendor = (_model(n) for n in ('Brand', 'Category', 'Product', 'Vendor'))
+    return {
+        'product_description': func.nullif(Product.description, ''),
+        'pack_size': func.nullif(Product.pack_size, ''),
+        'brand': Brand.name,
+        'category': Category.name,
+        'vendor': func.nullif(Vendor.name, ''),
+        'vendor_code': func.nullif(Vendor.code, ''),
+    }
+
+
+def join_dimensions(stmt, fields=None):
+    """Outer-join the dimensions behind fields (default: all) onto an invoice_records SELECT"""
+    from models import InvoiceRecord as R
+
+    for column, (model_name, _, dimension_fields) in DIMENSIONS.items():
+        if fields is not None and not set(dimension_fields) & set(fields) - {'product_code'}:
+            continue
+        model = _model(model_name)
+        stmt = stmt.outerjoin(model, getattr(R, column) == model.id)
+    return stmt
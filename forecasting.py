@@ -0,0 +1,212 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import func, select
+
+from extensions import db
+
+# Smoothing constants tried for simple exponential smoothing; every series is
+# fitted against all of them at once and keeps the one with the lowest error
+SES_ALPHAS = np.linspace(0.1, 0.9, 9)
+SEASON_LENGTH = 12
+# Two-sided 95% prediction interval
+INTERVAL_LEVEL = 95
+INTERVAL_Z = 1.959964
+MAX_HORIZON = 24
+
+# Candidate models, indexed by fit_models()'s per-series 'model' code
+MODELS = ('linear_trend', 'exponential_smoothing', 'seasonal_naive')
+
+# Fitted models per (user, data version); refit only after an upload changes the data
+FIT_CACHE_SIZE = 64
+_fits = OrderedDict()
+_fits_lock = threading.Lock()
+
+
+def _month_range(first, last):
+    """Every 'YYYY-MM' from first to last inclusive"""
+    year, month = int(first[:4]), int(first[5:7])
+    months = []
+    while True:
+        months.append(f'{year:04d}-{month:02d}')
+        if months[-1] >= last:
+            return months
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _add_months(month, n):
+    index = int(month[:4]) * 12 + int(month[5:7]) - 1 + n
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+def load_series(user_id):
+    """Monthly spend matrix from the rollup: one row per (store, category) series.
+
+    Alongside every store x category series there are per-store totals
+    (category 'all'), per-category totals across stores (store 'all') and the
+    overall total. Months with no spend are zero, so every row shares one
+    contiguous month axis.
+    """
+    from models import MonthlyRollup as M
+
+    rows = db.session.execute(
+        select(M.store_id, M.category, M.month, func.sum(M.total_spend))
+        .where(M.user_id == user_id)
+        .group_by(M.store_id, M.category, M.month)
+    ).all()
+    if not rows:
+        return [], [], np.zeros((0, 0))
+
+    months = _month_range(min(r[2] for r in rows), max(r[2] for r in rows))
+    month_index = {m: i for i, m in enumerate(months)}
+    keys = {}
+    cells = []
+    for store, category, month, spend in rows:
+        for key in ((store, category), (store, 'all'), ('all', category), ('all', 'all')):
+            cells.append((keys.setdefault(key, len(keys)), month_index[month], spend or 0.0))
+
+    spend = np.zeros((len(keys), len(months)))
+    series, columns, values = (np.array(v) for v in zip(*cells))
+    np.add.at(spend, (series.astype(np.int64), columns.astype(np.int64)), values)
+    return list(keys), months, spend
+
+
+def fit_models(y):
+    """Fit linear trend, exponential smoothing and seasonal naive to every row of y.
+
+    All series are fitted together with array operations; the only Python
+    loop is over months for the smoothing recursion. Each series keeps the
+    model with the lowest in-sample RMSE (one-step-ahead for smoothing and
+    seasonal naive, residual for the trend).
+    """
+    n_series, n = y.shape
+    t = np.arange(n, dtype=np.float64)
+    t_mean = t.mean() if n else 0.0
+    t_ss = ((t - t_mean) ** 2).sum()
+
+    # Linear trend by least squares
+    y_mean = y.mean(axis=1) if n else np.zeros(n_series)
+    slope = (((t - t_mean) * (y - y_mean[:, None])).sum(axis=1) / t_ss) if t_ss > 0 else np.zeros(n_series)
+    intercept = y_mean - slope * t_mean
+    residual = y - (intercept[:, None] + slope[:, None] * t)
+    linear_rmse = (np.sqrt((residual ** 2).sum(axis=1) / (n - 2)) if n > 2
+                   else np.full(n_series, np.inf))
+
+    # Simple exponential smoothing, every alpha at once: (alphas, series)
+    alphas = SES_ALPHAS[:, None]
+    level = np.repeat(y[None, :, 0], len(SES_ALPHAS), axis=0) if n else np.zeros((len(SES_ALPHAS), n_series))
+    sse = np.zeros_like(level)
+    for k in range(1, n):
+        error = y[None, :, k] - level
+        sse += error ** 2
+        level = level + alphas * error
+    best = sse.argmin(axis=0)
+    pick = np.arange(n_series)
+    ses_alpha = SES_ALPHAS[best]
+    ses_level = level[best, pick]
+    ses_rmse = np.sqrt(sse[best, pick] / (n - 1)) if n > 1 else np.zeros(n_series)
+
+    # Seasonal naive: next year's month repeats this year's
+    if n > SEASON_LENGTH:
+        seasonal_error = y[:, SEASON_LENGTH:] - y[:, :-SEASON_LENGTH]
+        seasonal_rmse = np.sqrt((seasonal_error ** 2).mean(axis=1))
+        last_season = y[:, -SEASON_LENGTH:]
+    else:
+        seasonal_rmse = np.full(n_series, np.inf)
+        last_season = np.zeros((n_series, SEASON_LENGTH))
+
+    rmse = np.vstack([linear_rmse, ses_rmse, seasonal_rmse])
+    return {
+        'n': n,
+        't_mean': t_mean,
+        't_ss': t_ss,
+        'model': rmse.argmin(axis=0),
+        'rmse': rmse.min(axis=0),
+        'slope': slope,
+        'intercept': intercept,
+        'alpha': ses_alpha,
+        'level': ses_level,
+        'last_season': last_season,
+    }
+
+
+def forecast(fit, horizon):
+    """(point, half_width) arrays of shape (series, horizon) from fitted models"""
+    n = fit['n']
+    h = np.arange(1, horizon + 1, dtype=np.float64)
+    rmse = fit['rmse'][:, None]
+
+    linear = fit['intercept'][:, None] + fit['slope'][:, None] * (n - 1 + h)
+    leverage = 1 + 1 / max(n, 1) + ((n - 1 + h - fit['t_mean']) ** 2 / fit['t_ss'] if fit['t_ss'] > 0 else 0)
+    linear_width = rmse * np.sqrt(leverage)
+
+    ses = np.repeat(fit['level'][:, None], horizon, axis=1)
+    ses_width = rmse * np.sqrt(1 + (h - 1) * fit['alpha'][:, None] ** 2)
+
+    season_index = (h.astype(np.int64) - 1) % SEASON_LENGTH
+    seasonal = fit['last_season'][:, season_index]
+    seasonal_width = rmse * np.sqrt((h - 1) // SEASON_LENGTH + 1)
+
+    model = fit['model'][:, None]
+    point = np.choose(model, [linear, ses, seasonal])
+    width = INTERVAL_Z * np.choose(model, [linear_width, ses_width, seasonal_width])
+    return point, width
+
+
+def _fitted(user_id, version):
+    key = (user_id, version)
+    with _fits_lock:
+        if key in _fits:
+            _fits.move_to_end(key)
+            return _fits[key]
+    keys, months, spend = load_series(user_id)
+    entry = (keys, months, spend, fit_models(spend))
+    with _fits_lock:
+        _fits[key] = entry
+        while len(_fits) > FIT_CACHE_SIZE:
+            _fits.popitem(last=False)
+    return entry
+
+
+def spend_forecast(user_id, filters):
+    """Monthly spend forecasts with 95% intervals per store and category.
+
+    ?store= picks the store's series (default: every series), ?horizon= the
+    number of months ahead (default 3). Models are fitted on the full monthly
+    history, so start/end do not apply.
+    """
+    from response_cache import data_version
+
+    horizon = filters['horizon']
+    keys, months, spend, fit = _fitted(user_id, data_version(user_id))
+    if not keys:
+        return {'horizon': horizon, 'level': INTERVAL_LEVEL, 'months': [], 'series': []}
+
+    point, width = forecast(fit, horizon)
+    future = [f'{_add_months(months[-1], i)}-01' for i in range(1, horizon + 1)]
+    series = []
+    for i, (store, category) in enumerate(keys):
+        if filters['store'] != 'all' and store != filters['store']:
+            continue
+        model = MODELS[fit['model'][i]]
+        params = {
+            'linear_trend': {'slope': float(fit['slope'][i]), 'intercept': float(fit['intercept'][i])},
+            'exponential_smoothing': {'alpha': float(fit['alpha'][i]), 'level': float(fit['level'][i])},
+            'seasonal_naive': {'seasonLength': SEASON_LENGTH},
+        }[model]
+        series.append({
+            'store': store,
+            'category': category,
+            'model': model,
+            'params': params,
+            'rmse': float(fit['rmse'][i]),
+            'history': [{'ds': f'{m}-01', 'y': float(v)} for m, v in zip(months, spend[i])],
+            'forecast': [{
+                'ds': ds,
+                'y': float(max(p, 0.0)),
+                'lower': float(max(p - w, 0.0)),
+                'upper': float(max(p + w, 0.0)),
+            } for ds, p, w in zip(future, point[i], width[i])],
+        })
+    return {'horizon': horizon, 'level': INTERVAL_LEVEL, 'months': [f'{m}-01' for m in months], 'series': series}
@@ -0,0 +1,212 @@
+import csv
+import gzip
+import io
+import time
+
+from sqlalchemy import delete, func, select, update
+
+from extensions import db
+from records import parse_invoice_date
+
+# Rows per multi-row INSERT. 20 bound columns per row keeps this well under the
+# parameter limits of both PostgreSQL (65535) and SQLite (32766).
+INSERT_BATCH_SIZE = 1000
+
+# Rows removed per committed transaction when deleting an upload
+DELETE_BATCH_SIZE = 5000
+
+DEDUP_COLUMNS = ('user_id', 'store_id', 'invoice_number', 'invoice_date', 'product_code')
+
+
+def safe_float(value):
+    """Safely convert a value to float, returning 0.0 if conversion fails"""
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _text(value):
+    """Dedup key columns are compared as text, so normalize numeric CSV values"""
+    return str(value) if value is not None else None
+
+
+def record_to_row(record_data, user_id, store_id, upload_id):
+    """Map an uploaded CSV/JSON record onto invoice_records column values.
+
+    Accepts both the stored/JSON field names and the raw PFG export headers
+    ('Product #', 'Category/Class', 'Zip Code', 'Vendor #').
+    """
+    return {
+        'user_id': user_id,
+        'upload_id': upload_id,
+        'store_id': store_id,
+        'invoice_number': _text(record_data.get('Invoice Number')),
+        'invoice_date': parse_invoice_date(_text(record_data.get('Invoice Date'))),
+        'customer_name': record_data.get('Customer Name'),
+        'address': record_data.get('Address'),
+        'city': record_data.get('City'),
+        'state': record_data.get('State'),
+        'zip_code': record_data.get('Zip') or record_data.get('Zip Code'),
+        'product_code': _text(record_data.get('Product Code') or record_data.get('Product #')),
+        'product_description': record_data.get('Product Description'),
+        'brand': record_data.get('Brand') or record_data.get('Brand Name'),
+        'category': (record_data.get('Product Class Description') or record_data.get('Category')
+                     or record_data.get('Category/Class')),
+        'pack_size': record_data.get('Pack Size'),
+        # Convert string values to floats for numeric fields with error handling
+        'quantity': safe_float(record_data.get('Qty Shipped') or record_data.get('Quantity')),
+        'unit_price': safe_float(record_data.get('Unit Price')),
+        'extended_price': safe_float(record_data.get('Ext. Price') or record_data.get('Extended Price')),
+        'vendor': record_data.get('Manufacturer Name') or record_data.get('Vendor'),
+        'vendor_code': record_data.get('Vendor Code') or record_data.get('Vendor #'),
+    }
+
+
+def dialect_insert(table):
+    """INSERT construct for the bound dialect, which supports ON CONFLICT clauses"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Bulk ingest is not supported on the {dialect} dialect")
+    return insert(table)
+
+
+def _insert_skip_duplicates(table):
+    """Build a dialect-specific INSERT that silently skips dedup-key collisions"""
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=list(DEDUP_COLUMNS))
+
+
+def insert_rows(rows):
+    """Insert prepared rows in multi-row batches, returning how many were new.
+
+    Duplicates (against existing rows or earlier rows in the same upload) are
+    dropped by the unique dedup index instead of a SELECT per record. Rows with
+    a NULL key column never collide, since unique indexes treat NULLs as
+    distinct on both PostgreSQL and SQLite. Descriptive text is swapped for
+    dimension ids batch by batch on the way in.
+    """
+    from dimensions import resolve_dimensions
+    from models import InvoiceRecord
+
+    stmt = _insert_skip_duplicates(InvoiceRecord.__table__)
+    inserted = 0
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = resolve_dimensions(rows[start:start + INSERT_BATCH_SIZE])
+        result = db.session.execute(stmt.values(batch))
+        inserted += result.rowcount
+    return inserted
+
+
+def open_csv_stream(stream, gzipped=False):
+    """Wrap a binary request stream in an incremental CSV row reader"""
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif not isinstance(stream, io.BufferedIOBase):
+        stream = io.BufferedReader(stream)
+    # utf-8-sig drops the BOM Excel-saved exports start with
+    return csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+
+def ingest_chunk(records, store_ids, user_id, filename, file_size, stores):
+    """Insert a chunk of uploaded records, each routed to its store (None skips it).
+
+    stores maps store_id -> {'store_id', 'upload_id', 'record_count',
+    'new_records', 'duplicate_records'} and is updated in place; an Upload is
+    created the first time a store appears. The rows this call inserted are
+    folded into the rollups and bump the store's data version, so a caller
+    committing chunk by chunk leaves every derived table consistent.
+    """
+    from models import InvoiceRecord, Upload
+    from response_cache import bump_data_version
+    from rollups import apply_upload
+
+    by_store = {}
+    for record, store_id in zip(records, store_ids):
+        if store_id is not None:
+            by_store.setdefault(store_id, []).append(record)
+
+    for store_id, store_records in by_store.items():
+        if store_id not in stores:
+            upload = Upload(
+                user_id=user_id,
+                store_id=store_id,
+                filename=filename,
+                file_size=file_size,
+                total_records=0
+            )
+            db.session.add(upload)
+            db.session.flush()
+            stores[store_id] = {
+                'store_id': store_id,
+                'upload_id': upload.id,
+                'record_count': 0,
+                'new_records': 0,
+                'duplicate_records': 0,
+            }
+        summary = stores[store_id]
+        upload_id = summary['upload_id']
+
+        last_id = db.session.execute(
+            select(func.max(InvoiceRecord.id)).where(InvoiceRecord.upload_id == upload_id)
+        ).scalar()
+        new_records = insert_rows([record_to_row(r, user_id, store_id, upload_id) for r in store_records])
+        summary['record_count'] += len(store_records)
+        summary['new_records'] += new_records
+        summary['duplicate_records'] += len(store_records) - new_records
+        db.session.execute(
+            update(Upload).where(Upload.id == upload_id).values(total_records=summary['record_count'])
+        )
+        if new_records:
+            apply_upload(upload_id, after_id=last_id)
+            bump_data_version(user_id, store_id)
+    return stores
+
+
+def delete_upload(upload, batch_size=DELETE_BATCH_SIZE):
+    """Delete an upload and its invoice rows in bounded, separately committed batches.
+
+    Each batch is the next batch_size ids found through the upload_id index.
+    Its rows are subtracted from the rollups and deleted by id range in the
+    same transaction, so the derived tables stay consistent between commits
+    and no other rows are scanned. Returns a report with the timing.
+    """
+    from models import InvoiceRecord, Upload
+    from response_cache import bump_data_version
+    from rollups import remove_records
+
+    started = time.perf_counter()
+    upload_id, user_id, store_id = upload.id, upload.user_id, upload.store_id
+    deleted_records = 0
+    batches = 0
+    while True:
+        ids = db.session.execute(
+            select(InvoiceRecord.id).where(InvoiceRecord.upload_id == upload_id)
+            .order_by(InvoiceRecord.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        batch = (InvoiceRecord.upload_id == upload_id, InvoiceRecord.id.between(ids[0], ids[-1]))
+        remove_records(*batch)
+        db.session.execute(delete(InvoiceRecord).where(*batch))
+        bump_data_version(user_id, store_id)
+        db.session.commit()
+        deleted_records += len(ids)
+        batches += 1
+
+    if upload in db.session:
+        db.session.expunge(upload)
+    db.session.execute(delete(Upload).where(Upload.id == upload_id))
+    db.session.commit()
+    return {
+        'upload_id': upload_id,
+        'store_id': store_id,
+        'deleted_records': deleted_records,
+        'batches': batches,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
@@ -0,0 +1,319 @@
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the per-route latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# REQUEST_LOG=all logs every request as a JSON line; slow (the default) only
+# those over the time or statement threshold; off logs none
+REQUEST_LOG = os.environ.get('REQUEST_LOG', 'slow')
+REQUEST_LOG_SLOW_MS = float(os.environ.get('REQUEST_LOG_SLOW_MS', 500))
+REQUEST_LOG_SLOW_QUERIES = int(os.environ.get('REQUEST_LOG_SLOW_QUERIES', 100))
+
+# With PROFILING=1 a request sent with ?profile=1 or an X-Profile: 1 header is
+# sampled every PROFILE_INTERVAL_SECONDS; the last PROFILES_KEPT reports are
+# kept for /metrics/profiles/<id>
+PROFILING_ENABLED = os.environ.get('PROFILING') == '1'
+PROFILE_INTERVAL_SECONDS = 0.002
+PROFILES_KEPT = 20
+PROFILE_TOP = 30
+
+# /metrics answers anyone presenting this bearer token. Without one it answers
+# loopback clients in development only: deployed behind Replit's proxy, the
+# client address is the proxy's, so there it is closed instead
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_LOOPBACK_ALLOWED = os.environ.get('REPLIT_DEPLOYMENT') != '1'
+
+_current = threading.local()
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a background thread"""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def report(self):
+        """Hottest functions by self and total samples, plus collapsed stacks for flame graphs"""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        return {
+            'samples': sum(self.stacks.values()),
+            'interval_ms': self.interval * 1000,
+            'self': [{'function': f, 'samples': n} for f, n in own.most_common(PROFILE_TOP)],
+            'total': [{'function': f, 'samples': n} for f, n in total.most_common(PROFILE_TOP)],
+            'collapsed': [f"{';'.join(stack)} {n}" for stack, n in self.stacks.most_common()],
+        }
+
+
+class RequestStats:
+    """Wall time, SQL statements, DB time and response bytes of one request"""
+
+    def __init__(self, method, route, path, profile):
+        self.started = time.perf_counter()
+        self.method = method
+        self.route = route
+        self.path = path
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.bytes = 0
+        self.status = None
+        self.finished = False
+        # Per-statement counts and time are only kept for profiled requests,
+        # where repeated statements are what give away an N+1 loop
+        self.statements = Counter() if profile else None
+        self.statement_seconds = Counter() if profile else None
+        self.profile_id = uuid.uuid4().hex[:12] if profile else None
+        self.profiler = None
+        if profile:
+            self.profiler = SamplingProfiler(threading.get_ident())
+            self.profiler.start()
+
+
+class RouteMetrics:
+    """Latency histogram and SQL/byte totals for one method and route"""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.bytes = 0
+        self.errors = 0
+
+    def observe(self, stats, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.seconds += seconds
+        self.queries += stats.queries
+        self.db_seconds += stats.db_seconds
+        self.bytes += stats.bytes
+        if stats.status >= 500:
+            self.errors += 1
+
+
+_routes = {}
+_routes_lock = threading.Lock()
+_profiles = OrderedDict()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_current, 'stats', None) is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_current, 'stats', None)
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if stats.statements is not None:
+        stats.statements[statement] += 1
+        stats.statement_seconds[statement] += elapsed
+
+
+class _CountingBody:
+    """Wraps a streamed body to count its bytes and finish the request's stats at the end"""
+
+    def __init__(self, body, stats):
+        self.body = body
+        self.stats = stats
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.stats.bytes += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+        _finish(self.stats)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        _finish(self.stats)
+
+
+def _wants_profile():
+    return PROFILING_ENABLED and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1')
+
+
+def _start_request():
+    route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    _current.stats = RequestStats(request.method, route, request.path, _wants_profile())
+
+
+def _end_request(response):
+    stats = getattr(_current, 'stats', None)
+    if stats is None:
+        return response
+    stats.status = response.status_code
+    if stats.profile_id:
+        response.headers['X-Profile-Id'] = stats.profile_id
+    if response.is_streamed and response.content_length is None:
+        # The body is produced after this hook returns; time and SQL keep
+        # accruing until the last chunk is sent
+        response.response = _CountingBody(response.response, stats)
+    else:
+        stats.bytes = response.content_length or 0
+        _finish(stats)
+    return response
+
+
+def _teardown_request(error):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None and stats.status is None:
+        # after_request never ran, e.g. an exception escaped the error handler
+        stats.status = 500
+        _finish(stats)
+
+
+def _finish(stats):
+    if stats.finished:
+        return
+    stats.finished = True
+    seconds = time.perf_counter() - stats.started
+    if getattr(_current, 'stats', None) is stats:
+        _current.stats = None
+    with _routes_lock:
+        _routes.setdefault((stats.method, stats.route), RouteMetrics()).observe(stats, seconds)
+
+    entry = {
+        'event': 'request',
+        'method': stats.method,
+        'route': stats.route,
+        'path': stats.path,
+        'status': stats.status,
+        'ms': round(seconds * 1000, 2),
+        'sql': stats.queries,
+        'sql_ms': round(stats.db_seconds * 1000, 2),
+        'bytes': stats.bytes,
+    }
+    if stats.profiler is not None:
+        stats.profiler.stop()
+        report = dict(entry, id=stats.profile_id, **stats.profiler.report())
+        report['statements'] = [{
+            'statement': s,
+            'count': n,
+            'ms': round(stats.statement_seconds[s] * 1000, 2),
+        } for s, n in stats.statements.most_common(PROFILE_TOP)]
+        with _routes_lock:
+            _profiles[stats.profile_id] = report
+            while len(_profiles) > PROFILES_KEPT:
+                _profiles.popitem(last=False)
+        entry['profile_id'] = stats.profile_id
+        entry['top_statements'] = report['statements'][:5]
+        entry['top_functions'] = report['self'][:5]
+
+    slow = entry['ms'] >= REQUEST_LOG_SLOW_MS or stats.queries >= REQUEST_LOG_SLOW_QUERIES
+    if REQUEST_LOG == 'all' or (REQUEST_LOG == 'slow' and slow) or stats.profiler is not None:
+        print(json.dumps(entry, separators=(',', ':')), flush=True)
+
+
+def init_app(app):
+    """Time every request of app and count the SQL each one runs.
+
+    Register before any other before_request hook so their queries are
+    counted too. Metrics are per process; each gunicorn worker reports its own.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_teardown_request)
+
+
+def metrics_allowed():
+    """Whether the current request may read /metrics"""
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        return hmac.compare_digest(supplied.encode('utf-8'), METRICS_TOKEN.encode('utf-8'))
+    return METRICS_LOOPBACK_ALLOWED and request.remote_addr in ('127.0.0.1', '::1')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_metrics():
+    """Per-route request metrics in the Prometheus text exposition format"""
+    with _routes_lock:
+        routes = sorted(_routes.items())
+        return _format_metrics(routes)
+
+
+def _format_metrics(routes):
+    lines = [
+        '# HELP http_request_duration_seconds Request wall time, including streaming the body.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (method, route), m in routes:
+        labels = f'method="{_label(method)}",route="{_label(route)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, m.buckets):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {m.count}')
+        lines.append(f'http_request_duration_seconds_sum{{{labels}}} {m.seconds:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{{labels}}} {m.count}')
+
+    counters = (
+        ('http_request_sql_statements_total', 'SQL statements executed while serving requests.', 'queries', 'd'),
+        ('http_request_db_seconds_total', 'Time spent in SQL statements while serving requests.', 'db_seconds', '.6f'),
+        ('http_response_bytes_total', 'Response body bytes sent.', 'bytes', 'd'),
+        ('http_request_errors_total', 'Requests answered with a 5xx status.', 'errors', 'd'),
+    )
+    for name, help_text, attribute, spec in counters:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for (method, route), m in routes:
+            lines.append(f'{name}{{method="{_label(method)}",route="{_label(route)}"}} '
+                         f'{format(getattr(m, attribute), spec)}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_profile(profile_id):
+    """A kept profiling report, or None once it has been evicted"""
+    with _routes_lock:
+        return _profiles.get(profile_id)
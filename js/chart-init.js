@@ -1137,16 +1137,40 @@ function saveAlertSettings() {
 
 // Export functionality
 function exportDataAsCSV() {
-  if (!analytics) return;
+  if (!StoreDataManager.persisted) {
+    // Data that was never saved exists only in the browser, so export what it computed
+    if (!analytics) return;
+
+    const csv = exportToCSV(analytics.data, true);
+    const blob = new Blob([csv], { type: 'text/csv' });
+    const url = URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = `pfg-analytics-export-${new Date().toISOString().slice(0, 10)}.csv`;
+    a.click();
+    URL.revokeObjectURL(url);
+    return;
+  }
+
+  // Streamed by the server so large exports never build the file in memory;
+  // it recomputes the rolling columns with the dashboard's window and threshold
+  const storeId = StoreDataManager.currentStore || 'all';
+  const params = new URLSearchParams({
+    window: currentFilters.volatilityWindow,
+    z: 2, // runFullAnalytics' default spikeThreshold
+    analytics: 1
+  });
+  if (currentFilters.startDate) params.set('start', currentFilters.startDate);
+  if (currentFilters.endDate) params.set('end', currentFilters.endDate);
+  if (currentFilters.category && currentFilters.category !== 'all') params.set('category', currentFilters.category);
+  if (currentFilters.vendor && currentFilters.vendor !== 'all') params.set('vendor', currentFilters.vendor);
+  if (currentFilters.minPrice) params.set('min_price', currentFilters.minPrice);
+  if (currentFilters.maxPrice) params.set('max_price', currentFilters.maxPrice);
+  if (currentFilters.spikesOnly) params.set('spikes_only', 1);
 
-  const csv = exportToCSV(analytics.data, true);
-  const blob = new Blob([csv], { type: 'text/csv' });
-  const url = URL.createObjectURL(blob);
   const a = document.createElement('a');
-  a.href = url;
-  a.download = `pfg-analytics-export-${new Date().toISOString().slice(0, 10)}.csv`;
+  a.href = `/api/export/${encodeURIComponent(storeId)}?${params}`;
   a.click();
-  URL.revokeObjectURL(url);
 }
 
 // Drill-down functionality
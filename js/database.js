@@ -10,7 +10,7 @@ const DatabaseManager = {
       
       // Check if response is JSON before parsing
       const contentType = response.headers.get('content-type');
-      if (!response.ok || !contentType || !contentType.includes('application/json')) {
+      if (!response.ok || !contentType || !contentType.includes('json')) {
         if (response.status === 401 || contentType?.includes('text/html')) {
           console.error('Authentication required - redirecting to login');
           window.location.reload(); // Reload to trigger OAuth login
@@ -63,14 +63,93 @@ const DatabaseManager = {
         throw new Error('Failed to save to database after retries');
       }
       
-      const result = await response.json();
-      return result;
+      return this.waitForUpload(await response.json());
     } catch (error) {
       console.error('Error saving to database:', error);
       throw error;
     }
   },
   
+  // Stream the raw export file to the server, which assigns stores and dedupes
+  async uploadCSV(file) {
+    try {
+      const params = new URLSearchParams({ filename: file.name });
+      const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/upload/csv?${params}`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': file.name.toLowerCase().endsWith('.gz') ? 'application/gzip' : 'text/csv'
+        },
+        body: file
+      });
+      
+      if (error === 'auth_required') {
+        return { success: false, message: 'Authentication required' };
+      }
+      
+      if (!response) {
+        throw new Error('Failed to upload file after retries');
+      }
+      
+      return this.waitForUpload(await response.json());
+    } catch (error) {
+      console.error('Error uploading CSV:', error);
+      throw error;
+    }
+  },
+  
+  // Remove a saved upload's records on the server
+  async deleteUpload(uploadId) {
+    const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/uploads/${uploadId}`, {
+      method: 'DELETE'
+    });
+    if (error === 'auth_required' || !response) {
+      return { success: false, message: 'Could not delete upload' };
+    }
+    return response.json();
+  },
+  
+  // Swap a saved upload for a corrected export file
+  async replaceUpload(uploadId, file) {
+    const params = new URLSearchParams({ filename: file.name });
+    const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/uploads/${uploadId}/replace?${params}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': file.name.toLowerCase().endsWith('.gz') ? 'application/gzip' : 'text/csv'
+      },
+      body: file
+    });
+    if (error === 'auth_required' || !response) {
+      return { success: false, message: 'Could not replace upload' };
+    }
+    return this.waitForUpload(await response.json());
+  },
+  
+  // Uploads are processed by a background job; poll its status until it finishes
+  async waitForUpload(job, onProgress) {
+    if (!job || !job.status_url) return job;
+    let delay = 500;
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, delay));
+      const { response, error } = await this.fetchWithRetry(`${this.baseURL}${job.status_url}`);
+      if (error === 'auth_required' || !response) {
+        return { success: false, message: 'Could not check upload status' };
+      }
+      const status = await response.json();
+      if (onProgress) onProgress(status);
+      if (status.status === 'done') {
+        return {
+          success: true,
+          ...status,
+          message: `Successfully uploaded ${status.new_records} new records (${status.duplicate_records} duplicates skipped)`
+        };
+      }
+      if (status.status === 'failed') {
+        return { success: false, ...status, message: status.error };
+      }
+      delay = Math.min(delay * 2, 5000);
+    }
+  },
+  
   async getRecords(storeId) {
     try {
       const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/records/${storeId}`);
@@ -92,6 +171,75 @@ const DatabaseManager = {
     }
   },
   
+  // Fetch records as dictionary-encoded columns (see records.build_columnar)
+  async getRecordsColumnar(storeId, fields) {
+    try {
+      const params = new URLSearchParams({ format: 'columnar' });
+      if (fields) params.set('fields', fields.join(','));
+      const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/records/${storeId}?${params}`);
+      
+      if (error === 'auth_required' || !response) {
+        return { count: 0, columns: {} };
+      }
+      
+      return this.decodeColumnar(await response.json());
+    } catch (error) {
+      console.error('Error fetching columnar records:', error);
+      return { count: 0, columns: {} };
+    }
+  },
+  
+  // Turn base64 column payloads into typed arrays without building row objects.
+  // 'dict' columns come back as { values, codes } (code -1 = null), 'days' as
+  // Int32Array of days since 1970-01-01 and 'float64' as Float64Array.
+  decodeColumnar(payload) {
+    const toBuffer = function(b64) {
+      const binary = atob(b64);
+      const bytes = new Uint8Array(binary.length);
+      for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+      return bytes.buffer;
+    };
+    
+    const columns = {};
+    Object.entries(payload.columns).forEach(([name, column]) => {
+      if (column.type === 'float64') {
+        columns[name] = new Float64Array(toBuffer(column.data));
+      } else if (column.type === 'days') {
+        columns[name] = new Int32Array(toBuffer(column.data));
+      } else {
+        columns[name] = { values: column.values, codes: new Int32Array(toBuffer(column.codes)) };
+      }
+    });
+    return { count: payload.count, columns };
+  },
+  
+  // Latest and trailing-average price of one product code at every store
+  async getPriceComparison(productCode, trailingDays = 90) {
+    const params = new URLSearchParams({ product: productCode, trailing_days: trailingDays });
+    return this.getAnalytics('price-comparison', params, { stores: [], gap: null });
+  },
+  
+  // Products with the largest cross-store gap in trailing-average price
+  async getPriceGaps(top = 20, trailingDays = 90) {
+    const params = new URLSearchParams({ top, trailing_days: trailingDays });
+    return this.getAnalytics('price-gaps', params, { products: [] });
+  },
+  
+  async getAnalytics(report, params, fallback) {
+    try {
+      const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/analytics/${report}?${params}`);
+      
+      if (error === 'auth_required' || !response) {
+        return fallback;
+      }
+      
+      return await response.json();
+    } catch (error) {
+      console.error(`Error fetching ${report}:`, error);
+      return fallback;
+    }
+  },
+  
   async getStores() {
     try {
       const { response, error } = await this.fetchWithRetry(`${this.baseURL}/api/stores`);
@@ -57,6 +57,9 @@ const StoreDataManager = {
   // Currently selected store
   currentStore: 'all',
 
+  // Whether the loaded data is what the database holds (no unsaved files on top)
+  persisted: false,
+
   // Initialize store data structures
   init: function() {
     // Initialize each store
@@ -155,6 +158,7 @@ const StoreDataManager = {
           };
 
           // Add data to each store
+          this.persisted = false;
           for (const storeId in storeGroups) {
             const storeData = storeGroups[storeId];
 
@@ -342,6 +346,7 @@ const StoreDataManager = {
         this.stores.all.data = this.stores.all.data.concat(this.stores[storeId].data);
       }.bind(this));
 
+      this.persisted = true;
       console.log(`Loaded and processed ${assignedCount} assigned records from database`);
       
       // Log detailed breakdown per store for verification
@@ -157,20 +157,14 @@ const StoreUI = {
           saveCheckbox.checked &&
           typeof DatabaseManager !== "undefined"
         ) {
-          for (const storeInfo of fileInfo.stores) {
-            try {
-              const dbResult = await DatabaseManager.saveToDatabase(
-                storeInfo.storeId,
-                file.name,
-                file.size,
-                storeInfo.records,
-              );
-              console.log("Saved to database:", dbResult);
-              totalNewRecords += dbResult.new_records || 0;
-              totalDuplicates += dbResult.duplicate_records || 0;
-            } catch (dbError) {
-              console.error("Database save error:", dbError);
-            }
+          // Send the raw file once; the server splits it by store
+          try {
+            const dbResult = await DatabaseManager.uploadCSV(file);
+            console.log("Saved to database:", dbResult);
+            totalNewRecords += dbResult.new_records || 0;
+            totalDuplicates += dbResult.duplicate_records || 0;
+          } catch (dbError) {
+            console.error("Database save error:", dbError);
           }
         }
 
@@ -0,0 +1,231 @@
+from sqlalchemy import Date, Float, func, inspect, select, delete, text
+
+from extensions import db
+
+# Rows converted per backfill transaction. Each batch commits on its own, so
+# no lock on invoice_records is held for longer than one batch.
+MIGRATION_BATCH_SIZE = 5000
+
+_NEW = '__new'
+_OLD = '__old'
+
+# Legacy column -> (target SQL type, per-dialect conversion of the old value)
+_LEGACY_DATE = {
+    'postgresql': ("CASE WHEN {c} ~ '^[0-9]{{1,2}}/[0-9]{{1,2}}/[0-9]{{4}}$' THEN to_date({c}, 'MM/DD/YYYY') "
+                   "WHEN {c} ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}$' THEN CAST({c} AS DATE) END"),
+    'sqlite': ("CASE WHEN {c} GLOB '[0-9]*/[0-9]*/[0-9][0-9][0-9][0-9]' AND {c} NOT GLOB '*[^0-9/]*' "
+               "AND {c} NOT GLOB '*[0-9][0-9][0-9]/*' THEN printf('%04d-%02d-%02d', substr({c}, -4), "
+               "substr({c}, 1, instr({c}, '/') - 1), "
+               "substr(substr({c}, instr({c}, '/') + 1), 1, instr(substr({c}, instr({c}, '/') + 1), '/') - 1)) "
+               "WHEN {c} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' THEN {c} END"),
+}
+_TO_NUMERIC = {dialect: 'CAST({c} AS NUMERIC(12, 4))' for dialect in ('postgresql', 'sqlite')}
+
+TYPED_COLUMNS = {
+    'invoice_date': ('DATE', _LEGACY_DATE),
+    'unit_price': ('NUMERIC(12, 4)', _TO_NUMERIC),
+    'extended_price': ('NUMERIC(12, 4)', _TO_NUMERIC),
+}
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _index_ddl(index, concurrently=False):
+    columns = ', '.join(c.name for c in index.columns)
+    return (f"CREATE {'UNIQUE ' if index.unique else ''}INDEX{' CONCURRENTLY' if concurrently else ''} "
+            f"IF NOT EXISTS {index.name} ON {index.table.name} ({columns})")
+
+
+def remove_duplicate_records():
+    """Drop duplicate rows so the unique dedup index can be built.
+
+    Only runs while the index is missing: on databases that predate it, where
+    the old check-then-insert path could leave duplicates, and right after the
+    date migration, which can make differently formatted dates collide. The
+    earliest copy of each row is kept.
+    """
+    from ingest import DEDUP_COLUMNS
+    from models import InvoiceRecord
+
+    existing = {i['name'] for i in inspect(db.session.get_bind()).get_indexes(InvoiceRecord.__tablename__)}
+    if 'uq_invoice_records_dedup' in existing:
+        return
+
+    # Rows with a NULL key column never conflict in the index, so leave them be
+    key = [getattr(InvoiceRecord, c) for c in DEDUP_COLUMNS]
+    complete = [k.is_not(None) for k in key]
+    keep = select(func.min(InvoiceRecord.id)).where(*complete).group_by(*key)
+    removed = db.session.execute(
+        delete(InvoiceRecord).where(*complete, InvoiceRecord.id.not_in(keep))
+    ).rowcount
+    db.session.commit()
+    if removed:
+        print(f"Removed {removed} duplicate invoice records before creating dedup index")
+
+
+def _legacy_columns():
+    """Typed columns still stored with their pre-migration type"""
+    columns = {c['name']: c['type'] for c in inspect(db.session.get_bind()).get_columns('invoice_records')}
+    legacy = []
+    for name in TYPED_COLUMNS:
+        current = columns.get(name)
+        if name == 'invoice_date' and current is not None and not isinstance(current, Date):
+            legacy.append(name)
+        elif name != 'invoice_date' and isinstance(current, Float):
+            legacy.append(name)
+    return legacy, columns
+
+
+def migrate_invoice_record_types(batch_size=MIGRATION_BATCH_SIZE):
+    """Convert legacy text dates and float prices to DATE / NUMERIC(12, 4).
+
+    Runs as add-column, batched backfill, then a short swap transaction, so
+    the table is never rewritten under one long lock. Safe to re-run after an
+    interruption: existing shadow columns are reused and only rows not yet
+    converted are touched. Values that do not convert (a date in neither
+    M/D/YYYY nor ISO form) are reported, and their old column is kept as
+    <name>__old rather than dropped.
+    """
+    from models import InvoiceRecord
+
+    legacy, columns = _legacy_columns()
+    if not legacy:
+        return
+    dialect = _dialect()
+    table = InvoiceRecord.__tablename__
+    print(f"Migrating invoice_records columns to typed storage: {', '.join(legacy)}")
+
+    for name in legacy:
+        if name + _NEW not in columns:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {name}{_NEW} {TYPED_COLUMNS[name][0]}"))
+    db.session.commit()
+
+    assignments = ', '.join(
+        f"{name}{_NEW} = {TYPED_COLUMNS[name][1][dialect].format(c=name)}" for name in legacy
+    )
+    pending = ' OR '.join(f"({name}{_NEW} IS NULL AND {name} IS NOT NULL)" for name in legacy)
+    backfill = text(f"UPDATE {table} SET {assignments} WHERE id >= :lo AND id < :hi AND ({pending})")
+
+    low, high = db.session.execute(select(func.min(InvoiceRecord.id), func.max(InvoiceRecord.id))).one()
+    if low is not None:
+        for start in range(low, high + 1, batch_size):
+            db.session.execute(backfill, {'lo': start, 'hi': start + batch_size})
+            db.session.commit()
+
+    # Swap: catch up rows written since the backfill, then rename the shadow
+    # columns into place. Indexes on the old columns go with them and are
+    # rebuilt by ensure_indexes().
+    db.session.execute(text(f"UPDATE {table} SET {assignments} WHERE {pending}"))
+    unconverted = {name: db.session.execute(text(
+        f"SELECT COUNT(*) FROM {table} WHERE {name}{_NEW} IS NULL AND {name} IS NOT NULL "
+        f"AND TRIM(CAST({name} AS TEXT)) <> ''")).scalar() for name in legacy}
+    for index in InvoiceRecord.__table__.indexes:
+        if any(c.name in legacy for c in index.columns):
+            db.session.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    for name in legacy:
+        db.session.execute(text(f"ALTER TABLE {table} RENAME COLUMN {name} TO {name}{_OLD}"))
+        db.session.execute(text(f"ALTER TABLE {table} RENAME COLUMN {name}{_NEW} TO {name}"))
+        if unconverted[name]:
+            print(f"{unconverted[name]} invoice_records.{name} values could not be converted and are now "
+                  f"NULL; the original values are kept in {name}{_OLD}")
+        else:
+            db.session.execute(text(f"ALTER TABLE {table} DROP COLUMN {name}{_OLD}"))
+    db.session.commit()
+    print("invoice_records typed column migration complete")
+
+
+def migrate_invoice_record_dimensions(batch_size=MIGRATION_BATCH_SIZE):
+    """Move legacy descriptive text columns into the dimension tables.
+
+    Adds the *_id columns, fills them batch by batch through the same lookup
+    cache ingest uses (committing per batch), then drops the text columns.
+    """
+    import models
+    from dimensions import DIMENSIONS, DIMENSION_FIELDS, resolve_dimensions
+    from models import InvoiceRecord
+
+    table = InvoiceRecord.__tablename__
+    columns = {c['name'] for c in inspect(db.session.get_bind()).get_columns(table)}
+    legacy = [f for f in DIMENSION_FIELDS if f in columns]
+    if not legacy:
+        return
+    print(f"Moving invoice_records text columns into dimension tables: {', '.join(legacy)}")
+
+    for column, (model_name, _, _) in DIMENSIONS.items():
+        if column not in columns:
+            references = getattr(models, model_name).__tablename__
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER REFERENCES {references}(id)"))
+    db.session.commit()
+
+    fields = ', '.join(['product_code', *legacy])
+    unresolved = ' AND '.join(f"{column} IS NULL" for column in DIMENSIONS)
+    has_text = ' OR '.join(f"{f} IS NOT NULL" for f in legacy)
+    update = text(f"UPDATE {table} SET {', '.join(f'{c} = :{c}' for c in DIMENSIONS)} WHERE id = :id")
+
+    def convert(where, params):
+        rows = [dict(r._mapping) for r in db.session.execute(
+            text(f"SELECT id, {fields} FROM {table} WHERE {where}"), params)]
+        if rows:
+            ids = [{'id': r['id'], **{c: r[c] for c in DIMENSIONS}} for r in resolve_dimensions(rows)]
+            db.session.execute(update, ids)
+        db.session.commit()
+
+    low, high = db.session.execute(select(func.min(InvoiceRecord.id), func.max(InvoiceRecord.id))).one()
+    if low is not None:
+        for start in range(low, high + 1, batch_size):
+            convert(f"id >= :lo AND id < :hi AND {unresolved} AND ({has_text})",
+                    {'lo': start, 'hi': start + batch_size})
+
+    # Catch up rows written by older processes since the backfill, then drop the text
+    convert(f"{unresolved} AND ({has_text})", {})
+    for field in legacy:
+        db.session.execute(text(f"ALTER TABLE {table} DROP COLUMN {field}"))
+    db.session.commit()
+    print("invoice_records dimension migration complete")
+
+
+def migrate_store_priority():
+    """Add stores.priority and number the seeded stores in the browser's matching order"""
+    from store_matcher import STORE_MATCH_ORDER
+
+    columns = {c['name'] for c in inspect(db.session.get_bind()).get_columns('stores')}
+    if 'priority' in columns:
+        return
+    db.session.execute(text("ALTER TABLE stores ADD COLUMN priority INTEGER"))
+    db.session.execute(text("UPDATE stores SET priority = :priority WHERE id = :id"),
+                       [{'id': store_id, 'priority': i} for i, store_id in enumerate(STORE_MATCH_ORDER)])
+    db.session.commit()
+    print("Added stores.priority")
+
+
+def ensure_indexes():
+    """Create any missing InvoiceRecord indexes (CONCURRENTLY on PostgreSQL)"""
+    from models import InvoiceRecord
+
+    existing = {i['name'] for i in inspect(db.session.get_bind()).get_indexes(InvoiceRecord.__tablename__)}
+    missing = [i for i in InvoiceRecord.__table__.indexes if i.name not in existing]
+    if not missing:
+        return
+
+    db.session.commit()
+    concurrently = _dialect() == 'postgresql'
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for index in missing:
+            print(f"Creating index {index.name}")
+            conn.execute(text(_index_ddl(index, concurrently=concurrently)))
+
+
+def run_migrations(batch_size=MIGRATION_BATCH_SIZE):
+    """Bring an existing database up to the current models; no-op when current.
+
+    Missing tables are created first, so the dimension columns added below
+    have tables to reference.
+    """
+    db.create_all()
+    migrate_store_priority()
+    migrate_invoice_record_types(batch_size)
+    migrate_invoice_record_dimensions(batch_size)
+    remove_duplicate_records()
+    ensure_indexes()
@@ -1,5 +1,5 @@
-from datetime import datetime
-from sqlalchemy import String, Integer, Float, DateTime, Text, ForeignKey, UniqueConstraint
+from datetime import date, datetime
+from sqlalchemy import String, Integer, Float, Numeric, Date, DateTime, Text, LargeBinary, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import Optional
 from extensions import Base, db
@@ -38,6 +38,9 @@ class Store(Base):
     name: Mapped[str] = mapped_column(String(100), nullable=False)
     location: Mapped[str] = mapped_column(String(200))
     address_patterns: Mapped[str] = mapped_column(Text)
+    # Lower is tried first when patterns of several stores occur in one
+    # address; stores without one come last (see store_matcher.py)
+    priority: Mapped[Optional[int]] = mapped_column(Integer)
 
     uploads: Mapped[list["Upload"]] = relationship(back_populates="store")
     records: Mapped[list["InvoiceRecord"]] = relationship(back_populates="store")
@@ -57,6 +60,48 @@ class Upload(Base):
     store: Mapped["Store"] = relationship(back_populates="uploads")
     records: Mapped[list["InvoiceRecord"]] = relationship(back_populates="upload")
 
+# Queued upload processed by a background worker (see upload_jobs.py). One job
+# can create an Upload per store it finds in the file.
+class UploadJob(Base):
+    __tablename__ = 'upload_jobs'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'))
+    kind: Mapped[str] = mapped_column(String(10), nullable=False)  # 'csv' or 'records'
+    store_id: Mapped[Optional[str]] = mapped_column(String(50), ForeignKey('stores.id'))  # records jobs; for a csv job, the replaced upload's store
+    filename: Mapped[str] = mapped_column(String(255), nullable=False)
+    file_size: Mapped[Optional[int]] = mapped_column(Integer)
+
+    status: Mapped[str] = mapped_column(String(20), default='queued')  # queued, running, done, failed
+    total_rows: Mapped[Optional[int]] = mapped_column(Integer)
+    # Checkpoint: input rows committed so far; a restarted job resumes after them
+    rows_processed: Mapped[int] = mapped_column(Integer, default=0)
+    new_records: Mapped[int] = mapped_column(Integer, default=0)
+    duplicate_records: Mapped[int] = mapped_column(Integer, default=0)
+    error_count: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+    # JSON: per-store Upload ids and counts, unassigned row samples
+    progress: Mapped[Optional[str]] = mapped_column(Text)
+
+    worker: Mapped[Optional[str]] = mapped_column(String(100))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        Index('ix_upload_jobs_status', 'status'),
+    )
+
+# A queued job's gzip'd input, split into numbered pieces so neither the
+# request nor the worker ever holds the whole file. Deleted once the job ends.
+class UploadJobChunk(Base):
+    __tablename__ = 'upload_job_chunks'
+
+    job_id: Mapped[int] = mapped_column(Integer, ForeignKey('upload_jobs.id'), primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
 class InvoiceRecord(Base):
     __tablename__ = 'invoice_records'
 
@@ -66,7 +111,7 @@ class InvoiceRecord(Base):
     store_id: Mapped[str] = mapped_column(String(50), ForeignKey('stores.id'))
 
     invoice_number: Mapped[Optional[str]] = mapped_column(String(50))
-    invoice_date: Mapped[Optional[str]] = mapped_column(String(50))
+    invoice_date: Mapped[Optional[date]] = mapped_column(Date)
     customer_name: Mapped[Optional[str]] = mapped_column(String(255))
     address: Mapped[Optional[str]] = mapped_column(String(500))
     city: Mapped[Optional[str]] = mapped_column(String(100))
@@ -74,18 +119,144 @@ class InvoiceRecord(Base):
     zip_code: Mapped[Optional[str]] = mapped_column(String(20))
 
     product_code: Mapped[Optional[str]] = mapped_column(String(100))
-    product_description: Mapped[Optional[str]] = mapped_column(Text)
-    brand: Mapped[Optional[str]] = mapped_column(String(100))
-    category: Mapped[Optional[str]] = mapped_column(String(100))
-    pack_size: Mapped[Optional[str]] = mapped_column(String(50))
+    product_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('products.id'))
+    brand_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('brands.id'))
+    category_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('categories.id'))
+    vendor_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('vendors.id'))
 
     quantity: Mapped[Optional[float]] = mapped_column(Float)
-    unit_price: Mapped[Optional[float]] = mapped_column(Float)
-    extended_price: Mapped[Optional[float]] = mapped_column(Float)
-
-    vendor: Mapped[Optional[str]] = mapped_column(String(255))
-    vendor_code: Mapped[Optional[str]] = mapped_column(String(50))
+    unit_price: Mapped[Optional[float]] = mapped_column(Numeric(12, 4, asdecimal=False))
+    extended_price: Mapped[Optional[float]] = mapped_column(Numeric(12, 4, asdecimal=False))
 
     user: Mapped["User"] = relationship()
     upload: Mapped["Upload"] = relationship(back_populates="records")
-    store: Mapped["Store"] = relationship(back_populates="records")
\ No newline at end of file
+    store: Mapped["Store"] = relationship(back_populates="records")
+    product: Mapped[Optional["Product"]] = relationship()
+    brand: Mapped[Optional["Brand"]] = relationship()
+    category: Mapped[Optional["Category"]] = relationship()
+    vendor: Mapped[Optional["Vendor"]] = relationship()
+
+    # Duplicate detection key for uploads; bulk inserts skip rows that collide with it.
+    # The others match the dashboard's access paths (see migrations.py for existing databases).
+    __table_args__ = (
+        Index('uq_invoice_records_dedup', 'user_id', 'store_id', 'invoice_number',
+              'invoice_date', 'product_code', unique=True),
+        Index('ix_invoice_records_user_store_date', 'user_id', 'store_id', 'invoice_date'),
+        Index('ix_invoice_records_user_product_date', 'user_id', 'product_code', 'invoice_date'),
+        Index('ix_invoice_records_user_category_date', 'user_id', 'category_id', 'invoice_date'),
+        Index('ix_invoice_records_user_vendor_date', 'user_id', 'vendor_id', 'invoice_date'),
+        Index('ix_invoice_records_upload_id', 'upload_id'),
+    )
+
+# Dimension tables shared by all users. Invoice lines reference them by id
+# instead of repeating the text; ingest resolves ids through dimensions.py.
+# Composite keys store missing parts as '' so they can back an upsert.
+class Product(Base):
+    __tablename__ = 'products'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    code: Mapped[str] = mapped_column(String(100), default='')
+    description: Mapped[str] = mapped_column(Text, default='')
+    pack_size: Mapped[str] = mapped_column(String(50), default='')
+
+    __table_args__ = (
+        UniqueConstraint('code', 'description', 'pack_size', name='uq_products_key'),
+    )
+
+class Brand(Base):
+    __tablename__ = 'brands'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(100), unique=True)
+
+class Category(Base):
+    __tablename__ = 'categories'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(100), unique=True)
+
+class Vendor(Base):
+    __tablename__ = 'vendors'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(255), default='')
+    code: Mapped[str] = mapped_column(String(50), default='')
+
+    __table_args__ = (
+        UniqueConstraint('name', 'code', name='uq_vendors_key'),
+    )
+
+# Bumped whenever a user's records for a store change; the response cache
+# derives ETags from it (see response_cache.py).
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), primary_key=True)
+    store_id: Mapped[str] = mapped_column(String(50), ForeignKey('stores.id'), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+# Pre-aggregated spend, maintained incrementally on upload (see rollups.py).
+# Key columns are never NULL so they can back an upsert conflict target.
+class DailyRollup(Base):
+    __tablename__ = 'rollup_daily'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'))
+    store_id: Mapped[str] = mapped_column(String(50), ForeignKey('stores.id'))
+    day: Mapped[date] = mapped_column(Date)
+    category: Mapped[str] = mapped_column(String(100))
+    vendor: Mapped[str] = mapped_column(String(255))
+    product_code: Mapped[str] = mapped_column(String(100))
+
+    line_count: Mapped[int] = mapped_column(Integer, default=0)
+    total_qty: Mapped[float] = mapped_column(Float, default=0.0)
+    total_spend: Mapped[float] = mapped_column(Float, default=0.0)
+    unit_price_sum: Mapped[float] = mapped_column(Float, default=0.0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'store_id', 'day', 'category', 'vendor', 'product_code',
+                         name='uq_rollup_daily_key'),
+    )
+
+class MonthlyRollup(Base):
+    __tablename__ = 'rollup_monthly'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'))
+    store_id: Mapped[str] = mapped_column(String(50), ForeignKey('stores.id'))
+    month: Mapped[str] = mapped_column(String(7))
+    category: Mapped[str] = mapped_column(String(100))
+    vendor: Mapped[str] = mapped_column(String(255))
+    product_code: Mapped[str] = mapped_column(String(100))
+
+    line_count: Mapped[int] = mapped_column(Integer, default=0)
+    total_qty: Mapped[float] = mapped_column(Float, default=0.0)
+    total_spend: Mapped[float] = mapped_column(Float, default=0.0)
+    unit_price_sum: Mapped[float] = mapped_column(Float, default=0.0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'store_id', 'month', 'category', 'vendor', 'product_code',
+                         name='uq_rollup_monthly_key'),
+    )
+
+# Price history per product code, store and day, maintained alongside the
+# rollups. Its key doubles as the price index: one range scan per product
+# returns every store's history in date order (see price_comparison.py).
+class ProductPriceRollup(Base):
+    __tablename__ = 'rollup_product_price'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'))
+    product_code: Mapped[str] = mapped_column(String(100))
+    store_id: Mapped[str] = mapped_column(String(50), ForeignKey('stores.id'))
+    day: Mapped[date] = mapped_column(Date)
+
+    line_count: Mapped[int] = mapped_column(Integer, default=0)
+    total_qty: Mapped[float] = mapped_column(Float, default=0.0)
+    total_spend: Mapped[float] = mapped_column(Float, default=0.0)
+    unit_price_sum: Mapped[float] = mapped_column(Float, default=0.0)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'product_code', 'store_id', 'day',
+                         name='uq_rollup_product_price_key'),
+    )
@@ -0,0 +1,149 @@
+import heapq
+from datetime import timedelta
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import select
+
+from extensions import db
+
+# Rollup rows fetched per round trip while scanning the price index
+PRICE_SCAN_BATCH = 5000
+MAX_TOP_PRODUCTS = 500
+
+
+def _price_history(user_id, filters, product_code=None):
+    """ProductPriceRollup rows in index order: by product code, then store, then day"""
+    from models import ProductPriceRollup as P
+
+    stmt = select(P.product_code, P.store_id, P.day, P.line_count, P.unit_price_sum).where(P.user_id == user_id)
+    if product_code is not None:
+        stmt = stmt.where(P.product_code == product_code)
+    if filters['start']:
+        stmt = stmt.where(P.day >= filters['start'])
+    if filters['end']:
+        stmt = stmt.where(P.day <= filters['end'])
+    stmt = stmt.order_by(P.product_code, P.store_id, P.day)
+    return db.session.execute(stmt.execution_options(yield_per=PRICE_SCAN_BATCH))
+
+
+def _compare_stores(rows, trailing_days):
+    """(as_of, per-store prices) from one product's rows in (store, day) order.
+
+    The trailing window is the same for every store: trailing_days up to the
+    product's most recent purchase at any store. Prices are averages of the
+    lines' unit prices, so a day with several lines counts each one.
+    """
+    as_of = max(r.day for r in rows)
+    since = as_of - timedelta(days=trailing_days)
+    stores = []
+    for store_id, history in groupby(rows, key=attrgetter('store_id')):
+        history = list(history)
+        latest = history[-1]
+        window = [r for r in history if r.day > since]
+        window_lines = sum(r.line_count for r in window)
+        stores.append({
+            'storeId': store_id,
+            'latestPrice': latest.unit_price_sum / latest.line_count,
+            'latestDate': latest.day.isoformat(),
+            'trailingAvgPrice': sum(r.unit_price_sum for r in window) / window_lines if window_lines else None,
+            'trailingLines': window_lines,
+            'totalLines': sum(r.line_count for r in history),
+        })
+    return as_of, stores
+
+
+def _gap(stores):
+    """Spread of trailing average prices across the stores that bought in the window, or None"""
+    priced = [s for s in stores if s['trailingAvgPrice'] is not None]
+    if len(priced) < 2:
+        return None
+    cheapest = min(priced, key=lambda s: s['trailingAvgPrice'])
+    priciest = max(priced, key=lambda s: s['trailingAvgPrice'])
+    gap = priciest['trailingAvgPrice'] - cheapest['trailingAvgPrice']
+    return {
+        'gap': gap,
+        'gapPercent': gap / cheapest['trailingAvgPrice'] * 100 if cheapest['trailingAvgPrice'] > 0 else 0,
+        'cheapestStore': cheapest['storeId'],
+        'priciestStore': priciest['storeId'],
+        'storeCount': len(priced),
+    }
+
+
+def _descriptions(product_codes):
+    """Latest-registered description per product code"""
+    from models import Product
+
+    if not product_codes:
+        return {}
+    rows = db.session.execute(
+        select(Product.code, Product.description)
+        .where(Product.code.in_(product_codes))
+        .order_by(Product.id)
+    )
+    return {code: description for code, description in rows}
+
+
+def _reject_store_filter(filters):
+    if filters['store'] != 'all':
+        raise ValueError('store does not apply: prices are compared across all stores')
+
+
+def price_comparison(user_id, filters):
+    """Latest and trailing-average price of ?product= (a product code) at every store.
+
+    One range scan of the product price index; ?trailing_days= sets the
+    window (default 90) and start/end bound the history considered.
+    """
+    _reject_store_filter(filters)
+    if not filters['product']:
+        raise ValueError('product (a product code) is required')
+
+    rows = _price_history(user_id, filters, filters['product']).all()
+    if not rows:
+        return {'productCode': filters['product'], 'description': None, 'asOf': None,
+                'trailingDays': filters['trailing_days'], 'stores': [], 'gap': None}
+    as_of, stores = _compare_stores(rows, filters['trailing_days'])
+    return {
+        'productCode': filters['product'],
+        'description': _descriptions([filters['product']]).get(filters['product']),
+        'asOf': as_of.isoformat(),
+        'trailingDays': filters['trailing_days'],
+        'stores': stores,
+        'gap': _gap(stores),
+    }
+
+
+def price_gaps(user_id, filters):
+    """The ?top= products (default 20) with the largest cross-store price gap.
+
+    The gap is between the cheapest and priciest store's trailing average
+    price, as a percentage of the cheapest, over stores that bought the
+    product within its trailing window. One pass over the price index in key
+    order, keeping only the current leaders.
+    """
+    _reject_store_filter(filters)
+
+    leaders = []
+    rows = _price_history(user_id, filters)
+    for product_code, product_rows in groupby(rows, key=attrgetter('product_code')):
+        as_of, stores = _compare_stores(list(product_rows), filters['trailing_days'])
+        gap = _gap(stores)
+        if gap is None:
+            continue
+        entry = (gap['gapPercent'], gap['gap'], product_code)
+        if len(leaders) < filters['top']:
+            heapq.heappush(leaders, (entry, as_of, stores, gap))
+        elif entry > leaders[0][0]:
+            heapq.heapreplace(leaders, (entry, as_of, stores, gap))
+
+    leaders.sort(key=lambda leader: leader[0], reverse=True)
+    descriptions = _descriptions([leader[0][2] for leader in leaders])
+    products = [{
+        'productCode': product_code,
+        'description': descriptions.get(product_code),
+        'asOf': as_of.isoformat(),
+        'stores': stores,
+        **gap,
+    } for (_, _, product_code), as_of, stores, gap in leaders]
+    return {'trailingDays': filters['trailing_days'], 'top': filters['top'], 'products': products}
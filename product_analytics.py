@@ -0,0 +1,291 @@
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, time
+
+import numpy as np
+from sqlalchemy import and_, case, func, select
+
+from extensions import db
+
+# Descriptions that must never be swapped for another product (branded
+# packaging) and ingredients worth testing first, as in js/product-analytics.js.
+# Each list is compiled into one alternation so a description is scanned once.
+NON_SUBSTITUTABLE = re.compile('|'.join((
+    r'pizza box', r'box.*pizza', r'packaging', r'branded.*box', r'custom.*box',
+    r'logo', r'sanpeggio', r'delivery.*bag', r'branded.*bag',
+)), re.IGNORECASE)
+CRITICAL = re.compile('|'.join((
+    r'dough', r'sauce', r'cheese', r'pepperoni', r'mozzarella',
+)), re.IGNORECASE)
+
+_DIGITS = re.compile(r'\d+')
+_PUNCTUATION = re.compile(r'[^\w\s]', re.ASCII)
+
+# Per-product aggregates per (user, data version, filters), shared by every
+# product report so opening the tab computes them once
+PRODUCT_CACHE_SIZE = 32
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def normalize_description(description):
+    """First three significant words, matching normalizeProductDescription"""
+    text = _PUNCTUATION.sub('', _DIGITS.sub('', description.lower()))
+    return ' '.join([w for w in text.split(' ') if len(w) > 2][:3])
+
+
+def _days_since(day, now):
+    """Fractional days from local midnight of day to now, like the browser's Date math"""
+    return (now - datetime.combine(day, time())).total_seconds() / 86400
+
+
+def _order_frequency(count, first, last):
+    """Orders per 30 days over a run of invoice lines, matching calculateOrderFrequency"""
+    if count < 2:
+        return 0
+    return count / ((last - first).days or 1) * 30
+
+
+def _query_products(user_id, filters):
+    """One row of aggregates per product, plus its consecutive price changes"""
+    from analytics import _columns, _where
+    from models import InvoiceRecord as R
+
+    c = _columns()
+    product = func.coalesce(c['product'], 'Unknown')
+    ordering = (c['day'], R.id)
+    lines = _where(select(
+        product.label('product'),
+        c['day'].label('day'),
+        c['unit_price'].label('price'),
+        c['qty'].label('qty'),
+        c['ext_price'].label('ext_price'),
+        R.product_code.label('product_code'),
+        c['brand'].label('brand'),
+        c['pack_size'].label('pack_size'),
+        c['vendor'].label('vendor'),
+        c['category'].label('category'),
+        func.row_number().over(partition_by=product, order_by=ordering).label('rn'),
+        func.count().over(partition_by=product).label('n'),
+        func.avg(c['unit_price']).over(partition_by=product).label('mean_price'),
+        func.lag(c['unit_price']).over(partition_by=product, order_by=ordering).label('prev_price'),
+    ), user_id, filters).where(c['day'].is_not(None)).subquery()
+
+    l = lines.c
+    first_half = l.rn * 2 <= l.n
+
+    def first_row(column):
+        return func.max(case((l.rn == 1, column)))
+
+    rows = db.session.execute(select(
+        l.product,
+        first_row(l.product_code).label('product_code'),
+        first_row(l.brand).label('brand'),
+        first_row(l.pack_size).label('pack_size'),
+        first_row(l.vendor).label('vendor'),
+        first_row(l.category).label('category'),
+        func.count().label('lines'),
+        func.sum(l.ext_price).label('spend'),
+        func.sum(l.qty).label('qty'),
+        func.sum((l.price - l.mean_price) * (l.price - l.mean_price)).label('price_ss'),
+        func.max(l.mean_price).label('mean_price'),
+        func.min(l.day).label('first_seen'),
+        func.max(l.day).label('last_seen'),
+        func.count(func.distinct(l.day)).label('order_days'),
+        func.sum(case((first_half, 1), else_=0)).label('first_count'),
+        func.min(case((first_half, l.day))).label('first_start'),
+        func.max(case((first_half, l.day))).label('first_end'),
+        func.min(case((~first_half, l.day))).label('second_start'),
+        func.max(case((~first_half, l.day))).label('second_end'),
+    ).group_by(l.product)).all()
+
+    changes = {}
+    for name, day, old, new in db.session.execute(
+        select(l.product, l.day, l.prev_price, l.price)
+        .where(and_(l.prev_price.is_not(None), func.abs(l.price - l.prev_price) > 0.01))
+        .order_by(l.product, l.rn)
+    ):
+        changes.setdefault(name, []).append({
+            'date': day.isoformat(),
+            'oldPrice': old,
+            'newPrice': new,
+            'change': new - old,
+            'changePercent': (new - old) / old * 100 if old > 0 else 0,
+        })
+    return rows, changes
+
+
+def _build_products(user_id, filters):
+    now = datetime.now()
+    rows, changes = _query_products(user_id, filters)
+    products = {}
+    for r in rows:
+        span = (r.last_seen - r.first_seen).days
+        days_since_last = int(_days_since(r.last_seen, now))
+        mean = r.mean_price or 0
+        volatility = (np.sqrt(r.price_ss / r.lines) / mean
+                      if r.lines >= 2 and mean != 0 else 0)
+        products[r.product] = {
+            'product': r.product,
+            'productId': r.product_code,
+            'description': r.product,
+            'brand': r.brand,
+            'packSize': r.pack_size,
+            'vendor': r.vendor,
+            'category': r.category,
+            'invoiceCount': r.lines,
+            'totalSpend': r.spend,
+            'totalQty': r.qty,
+            'avgPrice': r.spend / r.qty if r.qty > 0 else 0,
+            'priceVolatility': float(volatility),
+            'priceChanges': changes.get(r.product, []),
+            'avgDaysBetweenOrders': span / (r.order_days - 1) if r.order_days > 1 else 0,
+            'orderCount': r.order_days,
+            'productAge': span,
+            'status': 'Inactive' if days_since_last > 60 else 'Slow Moving' if days_since_last > 30 else 'Active',
+            'firstSeen': r.first_seen.isoformat(),
+            'lastSeen': r.last_seen.isoformat(),
+            # Used by the lifecycle split; dropped from the report payloads
+            '_halves': (
+                _order_frequency(r.first_count, r.first_start, r.first_end) if r.first_count else 0,
+                _order_frequency(r.lines - r.first_count, r.second_start, r.second_end),
+            ),
+            '_since': (_days_since(r.first_seen, now), _days_since(r.last_seen, now)),
+        }
+    return products
+
+
+def _products(user_id, filters):
+    """Per-product metrics, cached per data version"""
+    from response_cache import data_version
+
+    key = (user_id, data_version(user_id, filters['store']), filters['store'],
+           filters['start'], filters['end'], datetime.now().date())
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    products = _build_products(user_id, filters)
+    with _cache_lock:
+        _cache[key] = products
+        while len(_cache) > PRODUCT_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return products
+
+
+def _public(metric, **extra):
+    return {**{k: v for k, v in metric.items() if not k.startswith('_')}, **extra}
+
+
+def product_performance(user_id, filters):
+    """Per-product spend, price and ordering metrics, matching analyzeProductPerformance"""
+    return {name: _public(metric) for name, metric in _products(user_id, filters).items()}
+
+
+def abc_analysis(user_id, filters):
+    """Pareto A/B/C classes by cumulative spend share, matching performABCAnalysis"""
+    products = list(_products(user_id, filters).values())
+    spend = np.array([p['totalSpend'] for p in products], dtype=np.float64)
+    order = np.argsort(-spend, kind='stable')
+    total = spend.sum()
+    if total > 0:
+        cumulative = np.cumsum(spend[order]) / total * 100
+        share = spend[order] / total * 100
+    else:
+        cumulative = share = np.zeros(len(order))
+    classes = np.where(cumulative <= 80, 'A', np.where(cumulative <= 95, 'B', 'C'))
+
+    ranked = [
+        _public(products[i], abcCategory=str(cls), spendPercent=float(pct), cumulativePercent=float(cum))
+        for i, cls, pct, cum in zip(order, classes, share, cumulative)
+    ]
+    return {
+        'products': ranked,
+        'summary': {
+            'aItems': int((classes == 'A').sum()),
+            'bItems': int((classes == 'B').sum()),
+            'cItems': int((classes == 'C').sum()),
+            'totalItems': len(ranked),
+        },
+    }
+
+
+def product_lifecycle(user_id, filters):
+    """New / growing / mature / declining / at-risk products, matching analyzeProductLifecycle"""
+    lifecycle = {
+        'newProducts': [],
+        'growingProducts': [],
+        'matureProducts': [],
+        'decliningProducts': [],
+        'discontinuedRisk': [],
+    }
+    for metric in _products(user_id, filters).values():
+        since_first, since_last = metric['_since']
+        if since_first <= 30:
+            lifecycle['newProducts'].append(_public(metric, daysSinceIntroduction=int(since_first)))
+        elif since_last > 30:
+            lifecycle['discontinuedRisk'].append(_public(metric, daysSinceLastOrder=int(since_last)))
+        else:
+            first, second = metric['_halves']
+            change = (second - first) / first * 100 if first > 0 else 0
+            stage = ('growingProducts' if change > 20
+                     else 'decliningProducts' if change < -20 else 'matureProducts')
+            lifecycle[stage].append(_public(metric, frequencyChange=change))
+    return lifecycle
+
+
+def substitution_opportunities(user_id, filters):
+    """Cheaper equivalents within a category, matching findSubstitutionOpportunities.
+
+    Products are grouped by category and normalized description; each is
+    compared with the cheapest in its group.
+    """
+    groups = {}
+    for metric in _products(user_id, filters).values():
+        key = (metric['category'], normalize_description(metric['description']))
+        groups.setdefault(key, []).append(metric)
+
+    substitutions = []
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda p: p['avgPrice'])
+        cheaper = group[0]
+        if NON_SUBSTITUTABLE.search(cheaper['description']):
+            continue
+        for current in group[1:]:
+            if NON_SUBSTITUTABLE.search(current['description']):
+                continue
+            savings = current['avgPrice'] - cheaper['avgPrice']
+            savings_percent = savings / current['avgPrice'] * 100 if current['avgPrice'] > 0 else 0
+            span = current['productAge']
+            velocity = current['orderCount'] / (max(1, span) / 30)
+            monthly_qty = current['totalQty'] / max(1, span / 30)
+            annual_savings = savings * monthly_qty * 12
+            if not (savings_percent > 5 or annual_savings > 50):
+                continue
+            critical = bool(CRITICAL.search(current['description']))
+            substitutions.append({
+                'currentProduct': current['description'],
+                'currentBrand': current['brand'],
+                'currentPrice': current['avgPrice'],
+                'currentPackSize': current['packSize'],
+                'suggestedProduct': cheaper['description'],
+                'suggestedBrand': cheaper['brand'],
+                'suggestedPrice': cheaper['avgPrice'],
+                'suggestedPackSize': cheaper['packSize'],
+                'potentialSavings': savings,
+                'savingsPercent': savings_percent,
+                'monthlyUsage': monthly_qty,
+                'orderFrequency': velocity,
+                'annualSavings': annual_savings,
+                'isCritical': critical,
+                'substitutionType': 'Review Required' if critical else 'Safe to Substitute',
+                'category': current['category'],
+                'riskLevel': 'Medium' if critical else 'Low',
+                'recommendation': ('Test before full substitution - critical ingredient' if critical
+                                   else 'Safe to substitute - cost savings opportunity'),
+            })
+    substitutions.sort(key=lambda s: s['annualSavings'], reverse=True)
+    return substitutions
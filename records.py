@@ -0,0 +1,435 @@
+import base64
+import csv
+import io
+import json
+import sys
+import zlib
+from array import array
+from datetime import date, datetime
+from functools import lru_cache
+
+from sqlalchemy import func, or_, select
+
+# Output key -> InvoiceRecord column (or dimension field, see dimensions.py),
+# in the order the dashboard expects
+RECORD_FIELDS = {
+    'Invoice Number': 'invoice_number',
+    'Invoice Date': 'invoice_date',
+    'Customer Name': 'customer_name',
+    'Address': 'address',
+    'City': 'city',
+    'State': 'state',
+    'Zip': 'zip_code',
+    'Product Code': 'product_code',
+    'Product Description': 'product_description',
+    'Brand': 'brand',
+    'Category': 'category',
+    'Pack Size': 'pack_size',
+    'Quantity': 'quantity',
+    'Unit Price': 'unit_price',
+    'Extended Price': 'extended_price',
+    'Vendor': 'vendor',
+    'Vendor Code': 'vendor_code',
+    'Store ID': 'store_id',
+}
+
+# Rolling volatility columns an export can append, as the dashboard's CSV names them
+ANALYTICS_FIELDS = ['rollingMean', 'rollingStdDev', 'volatility', 'zScore', 'isSpike']
+
+# Columnar encoding per output key; every other field is dictionary-encoded text
+COLUMNAR_DAY_FIELDS = {'Invoice Date'}
+COLUMNAR_FLOAT_FIELDS = {'Quantity', 'Unit Price', 'Extended Price'}
+
+COLUMNAR_MIMETYPE = 'application/vnd.pfg.columnar+json'
+
+# Null markers in packed int32 arrays (dictionary codes and day numbers)
+NULL_CODE = -1
+NULL_DAY = -2147483648
+
+EPOCH = date(1970, 1, 1)
+
+MAX_PAGE_SIZE = 10000
+
+# Default page size for /api/records/query
+QUERY_PAGE_SIZE = 500
+
+# Rows fetched per round trip when streaming, and serialized per response chunk
+STREAM_BATCH_SIZE = 1000
+
+
+def resolve_fields(fields_arg):
+    """Parse a comma-separated ?fields= value into output keys (all keys if empty)"""
+    if not fields_arg:
+        return list(RECORD_FIELDS)
+    fields = [f.strip() for f in fields_arg.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in RECORD_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown record fields: {', '.join(unknown)}")
+    return fields
+
+
+def record_columns(fields):
+    """Column expressions for output keys; dimension fields need join_dimensions()"""
+    from dimensions import dimension_columns
+    from models import InvoiceRecord
+
+    dimensions = dimension_columns()
+    names = [RECORD_FIELDS[f] for f in fields]
+    return [dimensions[n] if n in dimensions else getattr(InvoiceRecord, n) for n in names]
+
+
+def select_records(user_id, store_id, fields, after=None, limit=None):
+    """Core select of (id, *fields) for a user's records, keyset-ordered by id.
+
+    Backs /api/records: ?fields= picks the keys, ?limit= and ?after= page by
+    id, with the next page's after value sent in X-Next-Cursor. Responses
+    carry an ETag tied to the store's data version, so revalidations get 304.
+    """
+    from dimensions import join_dimensions
+    from models import InvoiceRecord
+
+    names = [RECORD_FIELDS[f] for f in fields]
+    stmt = join_dimensions(select(InvoiceRecord.id, *record_columns(fields)), names)
+    stmt = stmt.where(InvoiceRecord.user_id == user_id)
+    if store_id != 'all':
+        stmt = stmt.where(InvoiceRecord.store_id == store_id)
+    if after is not None:
+        stmt = stmt.where(InvoiceRecord.id > after)
+    stmt = stmt.order_by(InvoiceRecord.id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _format_value(value):
+    """Dates go out as 'M/D/YYYY', the format the dashboard parses as a local date"""
+    if isinstance(value, date):
+        return f"{value.month}/{value.day}/{value.year}"
+    return value
+
+
+def record_dict(fields, row):
+    """Output object for an (id, *values) row"""
+    return {f: _format_value(v) for f, v in zip(fields, row[1:])}
+
+
+def _json_row(fields, row):
+    return json.dumps(record_dict(fields, row))
+
+
+def iter_json_array(rows, fields):
+    """Serialize (id, *values) rows as a JSON array of objects, chunk by chunk"""
+    yield '['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(_json_row(fields, row))
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+def iter_ndjson(rows, fields):
+    """Serialize (id, *values) rows as newline-delimited JSON objects.
+
+    /api/records sends this for ?format=ndjson or Accept: application/x-ndjson,
+    and a JSON array otherwise.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(_json_row(fields, row) + '\n')
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def parse_export_filters(args, store_id):
+    """Analytics filters plus filterData's category, vendor and price range.
+
+    category and vendor match the dashboard's parsed values ('Unknown' when
+    missing); 'all' or empty means no filter, as does a zero price bound.
+    /api/export also reads spikes_only (with window and z), fields,
+    analytics=1 to append ANALYTICS_FIELDS, and gzip=1 to save .csv.gz;
+    otherwise the CSV is gzip'd in transit when the client accepts it.
+    """
+    from analytics import parse_filters
+
+    filters = parse_filters(args)
+    filters['store'] = store_id
+    filters['category'] = args.get('category') if args.get('category') not in (None, '', 'all') else None
+    filters['vendor'] = args.get('vendor') if args.get('vendor') not in (None, '', 'all') else None
+    filters['min_price'] = float(args.get('min_price') or 0) or None
+    filters['max_price'] = float(args.get('max_price') or 0) or None
+    return filters
+
+
+def _dimension_predicate(fk, model, label, value):
+    """fk matches the dimension rows whose dashboard label is value.
+
+    The label is resolved against the small dimension table first, so the
+    invoice_records predicate is a plain id lookup the indexes can serve.
+    Missing dimensions read as 'Unknown' on the dashboard.
+    """
+    from extensions import db
+
+    ids = db.session.execute(select(model.id).where(label == value)).scalars().all()
+    predicate = fk.in_(ids)
+    return or_(predicate, fk.is_(None)) if value == 'Unknown' else predicate
+
+
+def filter_records(stmt, filters):
+    """Add filterData's category, vendor and unit price predicates to a _where() select"""
+    from analytics import _columns
+    from models import Category, InvoiceRecord, Vendor
+
+    c = _columns()
+    if filters['category']:
+        stmt = stmt.where(_dimension_predicate(InvoiceRecord.category_id, Category, c['category'], filters['category']))
+    if filters['vendor']:
+        stmt = stmt.where(_dimension_predicate(InvoiceRecord.vendor_id, Vendor, c['vendor'], filters['vendor']))
+    if filters['min_price']:
+        stmt = stmt.where(c['unit_price'] >= filters['min_price'])
+    if filters['max_price']:
+        stmt = stmt.where(c['unit_price'] <= filters['max_price'])
+    return stmt
+
+
+def select_export(user_id, filters, fields, after=None):
+    """(id, *fields) for the records an export with filters should contain, by id"""
+    from analytics import _where
+    from models import InvoiceRecord
+
+    stmt = filter_records(_where(select(InvoiceRecord.id, *record_columns(fields)), user_id, filters), filters)
+    if after is not None:
+        stmt = stmt.where(InvoiceRecord.id > after)
+    return stmt.order_by(InvoiceRecord.id)
+
+
+def with_analytics(rows, stats):
+    """Append ANALYTICS_FIELDS to id-ordered (id, *values) rows.
+
+    stats is volatility.row_stats output; rows it has no window for (no
+    invoice date) get blank columns.
+    """
+    ids, *columns = (column.tolist() for column in stats)
+    blank = ('',) * len(ANALYTICS_FIELDS)
+    i = 0
+    for row in rows:
+        while i < len(ids) and ids[i] < row[0]:
+            i += 1
+        if i < len(ids) and ids[i] == row[0]:
+            mean, std, cov, z, is_spike = (column[i] for column in columns)
+            yield (*row, mean, std, cov, z, 'true' if is_spike else 'false')
+        else:
+            yield (*row, *blank)
+
+
+def _text(source, key):
+    """A string member of a query body; '' when missing or null"""
+    value = source.get(key)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'{key} must be a string')
+    return value
+
+
+def _number(source, key, default, kinds=(int, float, str)):
+    """A numeric member of a query body (a number or numeric string); null only when default is None"""
+    value = source.get(key, default)
+    if value is None and default is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, kinds):
+        raise ValueError(f"{key} must be {'a number' if float in kinds else 'an integer'}")
+    return value
+
+
+def parse_query(body):
+    """Read a /api/records/query body: the dashboard's filterData object and paging.
+
+    {"store", "filters": {startDate, endDate, category, vendor, minPrice,
+    maxPrice, spikesOnly}, "window", "zThreshold", "fields", "limit", "after"}.
+    Returns (filters, fields, limit, after); bad values raise ValueError.
+    """
+    from analytics import parse_filters
+
+    if not isinstance(body, dict):
+        raise ValueError('Request body must be a JSON object')
+    query = body.get('filters') or {}
+    if not isinstance(query, dict):
+        raise ValueError('filters must be an object')
+    fields = body.get('fields')
+    if isinstance(fields, list) and all(isinstance(f, str) for f in fields):
+        fields = ','.join(fields)
+    elif fields is not None and not isinstance(fields, str):
+        raise ValueError('fields must be a list of field names')
+
+    args = {
+        'store': str(body.get('store') or 'all'),
+        'start': _text(query, 'startDate'),
+        'end': _text(query, 'endDate'),
+        'window': _number(body, 'window', 30, (int, str)),
+        'z': _number(body, 'zThreshold', 2),
+        'spikes_only': 'true' if query.get('spikesOnly') else '',
+        'category': _text(query, 'category'),
+        'vendor': _text(query, 'vendor'),
+        'min_price': _number(query, 'minPrice', None) or 0,
+        'max_price': _number(query, 'maxPrice', None) or 0,
+    }
+    filters = parse_export_filters(args, args['store'])
+    limit = int(_number(body, 'limit', QUERY_PAGE_SIZE, (int, str)))
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    after = _number(body, 'after', None, (int, str))
+    return filters, resolve_fields(fields), limit, int(after) if after is not None else None
+
+
+def query_summary(user_id, filters, spikes=None):
+    """filterData's summary totals over every matching record.
+
+    Aggregated in SQL; with spikes (a set of ids for spikesOnly) the matching
+    rows are summed here instead, as the spike flags are not stored.
+    """
+    from analytics import _columns, _where
+    from extensions import db
+    from models import InvoiceRecord
+
+    c = _columns()
+    if spikes is None:
+        row = db.session.execute(filter_records(_where(select(
+            func.count(),
+            func.min(c['day']),
+            func.max(c['day']),
+            func.coalesce(func.sum(c['ext_price']), 0.0),
+            func.coalesce(func.sum(c['qty']), 0.0),
+            func.count(func.distinct(c['category'])),
+            func.count(func.distinct(c['vendor'])),
+        ), user_id, filters), filters)).one()
+        count, first, last, spend, qty, categories, vendors = row
+    else:
+        stmt = filter_records(_where(select(
+            InvoiceRecord.id, c['day'], c['ext_price'], c['qty'], c['category'], c['vendor'],
+        ), user_id, filters), filters)
+        rows = [r for r in db.session.execute(stmt) if r[0] in spikes]
+        days = [r[1] for r in rows if r[1] is not None]
+        count = len(rows)
+        first, last = (min(days), max(days)) if days else (None, None)
+        spend = sum(r[2] for r in rows)
+        qty = sum(r[3] for r in rows)
+        categories = len({r[4] for r in rows})
+        vendors = len({r[5] for r in rows})
+    return {
+        'totalRecords': count,
+        'dateRange': {
+            'start': first.isoformat() if first else None,
+            'end': last.isoformat() if last else None,
+        },
+        'totalSpend': spend,
+        'totalQty': qty,
+        'uniqueCategories': categories,
+        'uniqueVendors': vendors,
+    }
+
+
+def iter_csv(rows, fields, gzipped=False):
+    """Serialize (id, *values) rows as quoted CSV, optionally as one gzip stream.
+
+    Starts with a UTF-8 byte order mark so Excel detects the encoding, and
+    writes dates as M/D/YYYY like the PFG export.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzipped else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def drain():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    buffer.write('\ufeff')
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        writer.writerow([_format_value(v) for v in row[1:]])
+        count += 1
+        if count % STREAM_BATCH_SIZE == 0:
+            chunk = drain()
+            if chunk:
+                yield chunk
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    yield chunk
+
+
+@lru_cache(maxsize=4096)
+def parse_invoice_date(value):
+    """Parse an export date ('6/26/2025' or ISO '2025-06-26') into a date, or None"""
+    if not value:
+        return None
+    for fmt in ('%m/%d/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _pack(typecode, values):
+    """Base64 of a little-endian packed array, which the browser maps onto a typed array"""
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode('ascii')
+
+
+def build_columnar(rows, fields):
+    """Encode (id, *values) rows column-by-column.
+
+    Text columns become a value dictionary plus int32 codes, dates become
+    int32 days since 1970-01-01, and numbers become float64 arrays. All
+    packed arrays are base64 little-endian so the payload stays JSON (and
+    gzip-friendly) while decoding needs no per-row objects. /api/records
+    sends this for ?format=columnar or Accept: COLUMNAR_MIMETYPE.
+    """
+    codes = {f: array('i') for f in fields if f not in COLUMNAR_FLOAT_FIELDS}
+    floats = {f: array('d') for f in fields if f in COLUMNAR_FLOAT_FIELDS}
+    dictionaries = {f: {} for f in fields
+                    if f not in COLUMNAR_FLOAT_FIELDS and f not in COLUMNAR_DAY_FIELDS}
+    count = 0
+
+    for row in rows:
+        count += 1
+        for field, value in zip(fields, row[1:]):
+            if field in floats:
+                floats[field].append(value if value is not None else float('nan'))
+            elif field in COLUMNAR_DAY_FIELDS:
+                day = value if isinstance(value, date) else parse_invoice_date(value)
+                codes[field].append((day - EPOCH).days if day else NULL_DAY)
+            elif value is None:
+                codes[field].append(NULL_CODE)
+            else:
+                lookup = dictionaries[field]
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(lookup)
+                codes[field].append(code)
+
+    columns = {}
+    for field in fields:
+        if field in floats:
+            columns[field] = {'type': 'float64', 'data': _pack('d', floats[field])}
+        elif field in COLUMNAR_DAY_FIELDS:
+            columns[field] = {'type': 'days', 'data': _pack('i', codes[field])}
+        else:
+            columns[field] = {'type': 'dict', 'values': list(dictionaries[field]),
+                              'codes': _pack('i', codes[field])}
+
+    return {'format': 'columnar-v1', 'count': count, 'columns': columns}
@@ -1,6 +1,9 @@
 import jwt
 import os
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from functools import wraps
 from urllib.parse import urlencode
 
@@ -19,31 +22,89 @@ from werkzeug.local import LocalProxy
 from extensions import db, login_manager
 
 
+# Every @require_login request loads the user and the OAuth token. Both are
+# cached per process for a short TTL and dropped explicitly when this process
+# changes them; other processes see changes once their entry expires.
+AUTH_CACHE_TTL_SECONDS = 60
+AUTH_CACHE_SIZE = 1024
+
+
+class TTLCache:
+    """Small thread-safe LRU whose entries expire ttl seconds after being set"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_users = TTLCache(AUTH_CACHE_TTL_SECONDS, AUTH_CACHE_SIZE)
+_tokens = TTLCache(AUTH_CACHE_TTL_SECONDS, AUTH_CACHE_SIZE)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    print(f"load_user called with user_id={user_id}")
-    user = db.session.get(User, user_id)
-    print(f"load_user returning: {user}")
+    user = _users.get(user_id)
+    if user is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            # Detach with every column loaded so later commits can't expire it
+            db.session.expunge(user)
+            _users.set(user_id, user)
     return user
 
 
 class UserSessionStorage(BaseStorage):
 
+    @staticmethod
+    def _key(blueprint):
+        return (current_user.get_id(), g.browser_session_key, blueprint.name)
+
     def get(self, blueprint):
         from models import OAuth
-        try:
-            token = db.session.query(OAuth).filter_by(
-                user_id=current_user.get_id(),
-                browser_session_key=g.browser_session_key,
-                provider=blueprint.name,
-            ).one().token
-        except NoResultFound:
-            token = None
-        return token
+        key = self._key(blueprint)
+        token = _tokens.get(key)
+        if token is None:
+            try:
+                token = db.session.query(OAuth).filter_by(
+                    user_id=key[0],
+                    browser_session_key=key[1],
+                    provider=key[2],
+                ).one().token
+            except NoResultFound:
+                return None
+            _tokens.set(key, token)
+        # Callers may update the token dict (expires_in); keep the cached one intact
+        return dict(token)
 
     def set(self, blueprint, token):
         from models import OAuth
+        _tokens.pop(self._key(blueprint))
         db.session.query(OAuth).filter_by(
             user_id=current_user.get_id(),
             browser_session_key=g.browser_session_key,
@@ -59,6 +120,7 @@ class UserSessionStorage(BaseStorage):
 
     def delete(self, blueprint):
         from models import OAuth
+        _tokens.pop(self._key(blueprint))
         db.session.query(OAuth).filter_by(
             user_id=current_user.get_id(),
             browser_session_key=g.browser_session_key,
@@ -102,15 +164,17 @@ def make_replit_blueprint(app=None):
 
     @replit_bp.before_app_request
     def set_applocal_session():
+        # Assigning only when missing keeps the cookie from being rewritten
+        # on requests that don't change the session
         if '_browser_session_key' not in session:
             session['_browser_session_key'] = uuid.uuid4().hex
-        session.modified = True
         g.browser_session_key = session['_browser_session_key']
         g.flask_dance_replit = replit_bp.session
 
     @replit_bp.route("/logout")
     def logout():
         del replit_bp.token
+        _users.pop(current_user.get_id())
         logout_user()
 
         end_session_endpoint = issuer_url + "/session/end"
@@ -146,6 +210,7 @@ def save_user(user_claims):
     user.profile_image_url = user_claims.get('profile_image_url')
     merged_user = db.session.merge(user)
     db.session.commit()
+    _users.pop(user.id)
     return merged_user
 
 
@@ -163,14 +228,10 @@ def logged_in(blueprint, token):
             options={"verify_signature": False}
         )
         
-        print(f"Successfully decoded user claims: {user_claims.get('email', 'no email')}")
-        
         user = save_user(user_claims)
         login_user(user, remember=True, fresh=True)  # Add remember=True for persistent session
         blueprint.token = token
         
-        print(f"User logged in successfully: user_id={user.id}, authenticated={user.is_authenticated}")
-        
         # Always redirect to ensure session is saved
         next_url = session.pop("next_url", None) or url_for('index')
         return redirect(next_url)
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+from sqlalchemy import func, select
+
+from extensions import db
+
+# Rendered payloads kept per process, evicted least recently used by total size.
+# Bodies larger than the entry limit are served but never cached.
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Response headers worth replaying from the cache
+_CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'X-Next-Cursor', 'Vary')
+
+
+def data_version(user_id, store_id='all'):
+    """Current data version for one of a user's stores, or all of them.
+
+    Versions only ever increase, so the sum across stores changes whenever any
+    one of them does.
+    """
+    from models import DataVersion
+
+    stmt = select(func.coalesce(func.sum(DataVersion.version), 0)).where(DataVersion.user_id == user_id)
+    if store_id != 'all':
+        stmt = stmt.where(DataVersion.store_id == store_id)
+    return db.session.execute(stmt).scalar()
+
+
+def bump_data_version(user_id, store_id):
+    """Mark a user's store data as changed (caller commits)"""
+    from ingest import dialect_insert
+    from models import DataVersion
+
+    table = DataVersion.__table__
+    stmt = dialect_insert(table).values(user_id=user_id, store_id=store_id, version=1)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'store_id'],
+        set_={'version': table.c.version + 1},
+    ))
+
+
+def versioned_etag(user_id, version):
+    """Strong ETag for the current request at a data version.
+
+    Covers everything the response varies on: the user, path and query
+    string, and the Accept / Accept-Encoding headers that pick the format.
+    """
+    variant = '\n'.join((
+        user_id, request.full_path,
+        request.headers.get('Accept', ''), request.headers.get('Accept-Encoding', ''),
+    ))
+    return f"v{version}-{hashlib.sha1(variant.encode('utf-8')).hexdigest()[:20]}"
+
+
+class ResponseCache:
+    """Thread-safe LRU of rendered bodies keyed by ETag, bounded by total bytes"""
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, headers):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+
+
+def _finish(response, etag):
+    response.set_etag(etag)
+    # Let the browser keep the body but revalidate it on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached_or_none(etag):
+    """304 or a replayed response when the client or this process has the payload"""
+    if request.if_none_match.contains(etag):
+        return _finish(Response(status=304), etag)
+    entry = response_cache.get(etag)
+    if entry is not None:
+        body, headers = entry
+        return _finish(Response(body, headers=headers), etag)
+    return None
+
+
+def _tee(chunks, etag, headers):
+    """Pass a streamed body through, caching it once complete if small enough"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        response_cache.put(etag, b''.join(parts), headers)
+
+
+def cache_response(response, etag):
+    """Tag a successful response with its ETag and store its rendered body"""
+    if response.status_code != 200:
+        return response
+    headers = [(k, v) for k, v in response.headers.items() if k in _CACHED_HEADERS]
+    if response.is_streamed:
+        response.response = _tee(response.iter_encoded(), etag, headers)
+    else:
+        response_cache.put(etag, response.get_data(), headers)
+    return _finish(response, etag)
@@ -0,0 +1,195 @@
+from sqlalchemy import bindparam, delete, func, select, update
+
+from extensions import db
+
+DAILY_KEY = ('user_id', 'store_id', 'day', 'category', 'vendor', 'product_code')
+MONTHLY_KEY = ('user_id', 'store_id', 'month', 'category', 'vendor', 'product_code')
+PRODUCT_PRICE_KEY = ('user_id', 'product_code', 'store_id', 'day')
+MEASURES = ('line_count', 'total_qty', 'total_spend', 'unit_price_sum')
+
+
+def _daily_aggregate(*where):
+    """SELECT of invoice_records grouped to the DailyRollup grain (dated rows only)"""
+    from analytics import _columns
+    from dimensions import join_dimensions
+    from models import InvoiceRecord as R
+
+    c = _columns()
+    key = [
+        R.user_id.label('user_id'),
+        R.store_id.label('store_id'),
+        c['day'].label('day'),
+        c['category'].label('category'),
+        c['vendor'].label('vendor'),
+        func.coalesce(R.product_code, '').label('product_code'),
+    ]
+    return join_dimensions(select(
+        *key,
+        func.count().label('line_count'),
+        func.sum(c['qty']).label('total_qty'),
+        func.sum(c['ext_price']).label('total_spend'),
+        func.sum(c['unit_price']).label('unit_price_sum'),
+    ), ('category', 'vendor')).where(c['day'].is_not(None), *where).group_by(*[k.element for k in key])
+
+
+def _fold(daily_rows, key):
+    """Sum daily aggregate rows into rows of a coarser rollup key"""
+    folded = {}
+    for row in daily_rows:
+        values = tuple(row['day'].strftime('%Y-%m') if k == 'month' else row[k] for k in key)
+        totals = folded.setdefault(values, dict.fromkeys(MEASURES, 0))
+        for measure in MEASURES:
+            totals[measure] += row[measure]
+    return [dict(zip(key, values), **totals) for values, totals in folded.items()]
+
+
+def _monthly_from_daily(daily_rows):
+    """Fold daily aggregate rows into MonthlyRollup rows"""
+    return _fold(daily_rows, MONTHLY_KEY)
+
+
+def _product_prices_from_daily(daily_rows):
+    """Fold daily aggregate rows into ProductPriceRollup rows; lines without a product code are left out"""
+    return _fold([row for row in daily_rows if row['product_code']], PRODUCT_PRICE_KEY)
+
+
+def _upsert_add(table, key, rows):
+    """Add rows' measures onto existing rollup rows, inserting missing keys"""
+    from ingest import dialect_insert
+
+    if not rows:
+        return
+    stmt = dialect_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(key),
+        set_={m: getattr(table.c, m) + getattr(stmt.excluded, m) for m in MEASURES},
+    )
+    db.session.execute(stmt, rows)
+
+
+def _subtract(table, key, rows):
+    """Remove rows' measures from rollup rows, dropping keys that reach zero lines"""
+    if not rows:
+        return
+    stmt = (
+        update(table)
+        .where(*[getattr(table.c, k) == bindparam(f'k_{k}') for k in key])
+        .values({m: getattr(table.c, m) - bindparam(f'd_{m}') for m in MEASURES})
+    )
+    db.session.connection().execute(stmt, [
+        {**{f'k_{k}': row[k] for k in key}, **{f'd_{m}': row[m] for m in MEASURES}}
+        for row in rows
+    ])
+    for user_id, store_id in {(row['user_id'], row['store_id']) for row in rows}:
+        db.session.execute(delete(table).where(
+            table.c.user_id == user_id, table.c.store_id == store_id, table.c.line_count <= 0
+        ))
+
+
+def apply_upload(upload_id, after_id=None):
+    """Fold an upload's newly inserted rows into the rollups (caller commits).
+
+    Only rows that survived deduplication carry this upload_id, so duplicates
+    skipped by the insert are never double counted. after_id limits it to rows
+    inserted after that id, for uploads applied batch by batch.
+    """
+    from models import DailyRollup, InvoiceRecord, MonthlyRollup, ProductPriceRollup
+
+    where = [InvoiceRecord.upload_id == upload_id]
+    if after_id is not None:
+        where.append(InvoiceRecord.id > after_id)
+    daily = [row._asdict() for row in db.session.execute(_daily_aggregate(*where))]
+    _upsert_add(DailyRollup.__table__, DAILY_KEY, daily)
+    _upsert_add(MonthlyRollup.__table__, MONTHLY_KEY, _monthly_from_daily(daily))
+    _upsert_add(ProductPriceRollup.__table__, PRODUCT_PRICE_KEY, _product_prices_from_daily(daily))
+
+
+def remove_records(*where):
+    """Subtract the invoice rows matching where from the rollups; call before deleting them"""
+    from models import DailyRollup, MonthlyRollup, ProductPriceRollup
+
+    daily = [row._asdict() for row in db.session.execute(_daily_aggregate(*where))]
+    _subtract(DailyRollup.__table__, DAILY_KEY, daily)
+    _subtract(MonthlyRollup.__table__, MONTHLY_KEY, _monthly_from_daily(daily))
+    _subtract(ProductPriceRollup.__table__, PRODUCT_PRICE_KEY, _product_prices_from_daily(daily))
+
+
+def rebuild(user_id=None):
+    """Recompute the rollups from invoice_records for one user, or everyone"""
+    from models import DailyRollup, InvoiceRecord, MonthlyRollup, ProductPriceRollup
+
+    daily_table = DailyRollup.__table__
+    for table in (daily_table, MonthlyRollup.__table__, ProductPriceRollup.__table__):
+        stmt = delete(table)
+        if user_id is not None:
+            stmt = stmt.where(table.c.user_id == user_id)
+        db.session.execute(stmt)
+
+    where = [InvoiceRecord.user_id == user_id] if user_id is not None else []
+    daily = _daily_aggregate(*where)
+    db.session.execute(daily_table.insert().from_select([*DAILY_KEY, *MEASURES], daily))
+
+    _fill_monthly(user_id)
+    _fill_product_prices(user_id)
+
+
+def _fill_monthly(user_id=None):
+    """Insert MonthlyRollup rows folded from the daily rollup (rows must not exist yet)"""
+    from analytics import invoice_month
+    from models import DailyRollup, MonthlyRollup
+
+    d = DailyRollup.__table__.c
+    month = invoice_month(d.day)
+    monthly = select(
+        d.user_id, d.store_id, month, d.category, d.vendor, d.product_code,
+        *[func.sum(getattr(d, m)) for m in MEASURES]
+    ).group_by(d.user_id, d.store_id, month, d.category, d.vendor, d.product_code)
+    if user_id is not None:
+        monthly = monthly.where(d.user_id == user_id)
+    db.session.execute(MonthlyRollup.__table__.insert().from_select([*MONTHLY_KEY, *MEASURES], monthly))
+
+
+def _fill_product_prices(user_id=None):
+    """Insert ProductPriceRollup rows folded from the daily rollup (rows must not exist yet)"""
+    from models import DailyRollup, ProductPriceRollup
+
+    d = DailyRollup.__table__.c
+    prices = select(
+        d.user_id, d.product_code, d.store_id, d.day,
+        *[func.sum(getattr(d, m)) for m in MEASURES]
+    ).where(d.product_code != '').group_by(d.user_id, d.product_code, d.store_id, d.day)
+    if user_id is not None:
+        prices = prices.where(d.user_id == user_id)
+    db.session.execute(ProductPriceRollup.__table__.insert().from_select([*PRODUCT_PRICE_KEY, *MEASURES], prices))
+
+
+def ensure_rollups():
+    """Populate the rollups on databases that have records but predate them.
+
+    Each table is checked on its own against the records it should hold, so
+    a product price rollup left empty by records without product codes does
+    not trigger a rebuild on every start.
+    """
+    from models import DailyRollup, InvoiceRecord, MonthlyRollup, ProductPriceRollup
+
+    def exists(stmt):
+        return db.session.execute(stmt.limit(1)).first() is not None
+
+    dated = select(InvoiceRecord.id).where(InvoiceRecord.invoice_date.is_not(None))
+    if not exists(dated):
+        return
+    if not exists(select(DailyRollup.id)):
+        rebuild()
+        rebuilt = ['daily', 'monthly', 'product price']
+    else:
+        rebuilt = []
+        if not exists(select(MonthlyRollup.id)):
+            _fill_monthly()
+            rebuilt.append('monthly')
+        coded = dated.where(InvoiceRecord.product_code.is_not(None), InvoiceRecord.product_code != '')
+        if not exists(select(ProductPriceRollup.id)) and exists(coded):
+            _fill_product_prices()
+            rebuilt.append('product price')
+    if rebuilt:
+        db.session.commit()
+        print(f"Rollup tables rebuilt from existing invoice records: {', '.join(rebuilt)}")
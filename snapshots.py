@@ -0,0 +1,289 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select
+
+from extensions import db
+
+# Local directory shared by every worker process on the machine
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR') or os.path.join(tempfile.gettempdir(), 'pfg-snapshots')
+
+# Disk budget for all snapshots; beyond it the least recently opened go first
+SNAPSHOT_MAX_BYTES = int(os.environ.get('SNAPSHOT_MAX_BYTES', 1024 ** 3))
+
+# A build directory this old belongs to a worker that died mid-build
+SNAPSHOT_STALE_BUILD_SECONDS = 3600
+
+# Invoice rows fetched per batch while building
+SNAPSHOT_BUILD_BATCH = 50000
+
+# Snapshots each process keeps mapped
+SNAPSHOT_OPEN_LIMIT = 16
+
+NULL_DAY = np.iinfo(np.int32).min
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Numeric column files
+NUMERIC_COLUMNS = {'id': np.int64, 'day': np.int32, 'qty': np.float64, 'unit_price': np.float64,
+                   'ext_price': np.float64}
+
+# Dictionary-encoded columns: int32 codes into a label list kept in meta.json.
+# Labels are the dashboard's values (see analytics._columns); None is a label too,
+# so every code is a valid index.
+CODED_COLUMNS = ('store', 'invoice', 'category', 'vendor', 'brand', 'product', 'pack_size')
+
+_open = OrderedDict()
+_open_lock = threading.Lock()
+
+
+class Snapshot:
+    """One user's invoice lines at one data version, as read-only memory-mapped arrays.
+
+    Rows are in id order. Numeric columns are days since 1970-01-01 (NULL_DAY
+    when missing), quantity and extended price (0 when missing) and the
+    effective unit price; coded columns index into labels[name].
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.count = meta['count']
+        self.labels = meta['labels']
+        self._codes = {}
+        for name in (*NUMERIC_COLUMNS, *CODED_COLUMNS):
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    def code(self, name, label):
+        """Code of a label in a coded column, or -1 when no row has it"""
+        lookup = self._codes.get(name)
+        if lookup is None:
+            lookup = self._codes[name] = {v: i for i, v in enumerate(self.labels[name])}
+        return lookup.get(label, -1)
+
+    def mask(self, filters, dated=False):
+        """Rows matching the analytics store/start/end filters; dated drops rows without a date.
+
+        Export filters (category, vendor, min_price, max_price) apply when set.
+        """
+        keep = np.ones(self.count, dtype=bool)
+        if filters['store'] != 'all':
+            keep &= self.store == self.code('store', filters['store'])
+        if dated or filters['start'] or filters['end']:
+            keep &= self.day != NULL_DAY
+        if filters['start']:
+            keep &= self.day >= filters['start'].toordinal() - EPOCH_ORDINAL
+        if filters['end']:
+            keep &= self.day <= filters['end'].toordinal() - EPOCH_ORDINAL
+        for name in ('category', 'vendor'):
+            if filters.get(name):
+                keep &= getattr(self, name) == self.code(name, filters[name])
+        if filters.get('min_price'):
+            keep &= self.unit_price >= filters['min_price']
+        if filters.get('max_price'):
+            keep &= self.unit_price <= filters['max_price']
+        return keep
+
+
+def regroup(codes, labels):
+    """(codes, labels) with codes whose labels are equal merged into one"""
+    unique = {}
+    remap = np.array([unique.setdefault(label, len(unique)) for label in labels], dtype=np.int64)
+    return remap[codes] if len(remap) else np.zeros(0, dtype=np.int64), list(unique)
+
+
+def _user_dir(user_id):
+    return os.path.join(SNAPSHOT_DIR, hashlib.sha1(user_id.encode('utf-8')).hexdigest()[:16])
+
+
+def _encode_dimension(ids, labels, missing):
+    """Dimension ids (-1 for NULL) -> (codes, labels), one code per distinct label"""
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    codes, names = regroup(inverse, [labels.get(int(i), missing) if i >= 0 else missing for i in unique_ids])
+    return codes.astype(np.int32), names
+
+
+def _dimension_labels():
+    """id -> dashboard label per coded dimension column, with the label of a NULL id"""
+    from analytics import _columns
+    from dimensions import dimension_columns
+    from models import Brand, Category, Product, Vendor
+
+    c = _columns()
+    queries = {
+        'category': (select(Category.id, c['category']), 'Unknown'),
+        'vendor': (select(Vendor.id, dimension_columns()['vendor']), None),
+        'brand': (select(Brand.id, c['brand']), 'Generic'),
+        'product': (select(Product.id, c['product']), None),
+        'pack_size': (select(Product.id, c['pack_size']), 'Unknown'),
+    }
+    return {name: (dict(db.session.execute(stmt).all()), missing) for name, (stmt, missing) in queries.items()}
+
+
+def _build(user_id, path):
+    """Write the user's snapshot into path (a fresh directory)"""
+    from models import InvoiceRecord as R
+
+    result = db.session.execute(
+        select(R.id, R.invoice_date, R.store_id, R.invoice_number, R.category_id, R.vendor_id,
+               R.brand_id, R.product_id, R.quantity, R.unit_price, R.extended_price)
+        .where(R.user_id == user_id)
+        .order_by(R.id)
+        .execution_options(yield_per=SNAPSHOT_BUILD_BATCH)
+    )
+    parts = {name: [] for name in ('id', 'day', 'store', 'invoice', 'category', 'vendor', 'product',
+                                   'brand', 'quantity', 'unit_price', 'extended_price')}
+    text_codes = {'store': {}, 'invoice': {}}
+    for batch in result.partitions():
+        n = len(batch)
+        parts['id'].append(np.fromiter((r[0] for r in batch), dtype=np.int64, count=n))
+        parts['day'].append(np.fromiter((r[1].toordinal() - EPOCH_ORDINAL if r[1] else NULL_DAY for r in batch),
+                                        dtype=np.int32, count=n))
+        for name, index in (('store', 2), ('invoice', 3)):
+            lookup = text_codes[name]
+            parts[name].append(np.fromiter((lookup.setdefault(r[index], len(lookup)) for r in batch),
+                                           dtype=np.int32, count=n))
+        for name, index in (('category', 4), ('vendor', 5), ('brand', 6), ('product', 7)):
+            parts[name].append(np.fromiter((-1 if r[index] is None else r[index] for r in batch),
+                                           dtype=np.int64, count=n))
+        for name, index in (('quantity', 8), ('unit_price', 9), ('extended_price', 10)):
+            parts[name].append(np.array([r[index] for r in batch], dtype=np.float64))
+
+    def column(name, dtype):
+        return np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dtype)
+
+    quantity = column('quantity', np.float64)
+    extended = column('extended_price', np.float64)
+    unit = column('unit_price', np.float64)
+    # Unit price falls back to ext / qty when missing, as in analytics._columns
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effective = np.where(unit > 0, unit, np.where(quantity > 0, extended / quantity, 0.0))
+
+    arrays = {
+        'id': column('id', np.int64),
+        'day': column('day', np.int32),
+        'qty': np.nan_to_num(quantity, nan=0.0),
+        'unit_price': effective,
+        'ext_price': np.nan_to_num(extended, nan=0.0),
+        'store': column('store', np.int32),
+        'invoice': column('invoice', np.int32),
+    }
+    labels = {name: list(lookup) for name, lookup in text_codes.items()}
+    dimension_ids = {name: column(name, np.int64) for name in ('category', 'vendor', 'brand')}
+    dimension_ids['pack_size'] = dimension_ids['product'] = column('product', np.int64)
+    for name, (id_labels, missing) in _dimension_labels().items():
+        arrays[name], labels[name] = _encode_dimension(dimension_ids[name], id_labels, missing)
+
+    for name, values in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), values)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'user_id': user_id, 'count': len(arrays['id']), 'labels': labels}, f)
+
+
+def _ensure_built(user_id, version):
+    """Path of the snapshot for (user, version), building it if no worker has yet.
+
+    Builds are serialized per user with a file lock, so concurrent workers
+    wait for the first one instead of each querying the full history. The
+    finished directory is renamed into place, so readers never see a partial one.
+    """
+    user_dir = _user_dir(user_id)
+    path = os.path.join(user_dir, str(version))
+    if os.path.isdir(path):
+        return path
+    os.makedirs(user_dir, exist_ok=True)
+    with open(os.path.join(user_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(path):
+            building = tempfile.mkdtemp(prefix=f'{version}.build-', dir=user_dir)
+            try:
+                _build(user_id, building)
+                os.rename(building, path)
+            except BaseException:
+                shutil.rmtree(building, ignore_errors=True)
+                raise
+    evict(keep=path)
+    return path
+
+
+def user_snapshot(user_id):
+    """The user's snapshot at their current data version, mapped read-only.
+
+    Built lazily on first use after an upload changes the version; the
+    previous version is then removed from disk.
+    """
+    from response_cache import data_version
+
+    key = (user_id, data_version(user_id))
+    with _open_lock:
+        snapshot = _open.get(key)
+        if snapshot is not None:
+            _open.move_to_end(key)
+            return snapshot
+    try:
+        path = _ensure_built(*key)
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        # Evicted between the check and the open; build it again
+        path = _ensure_built(*key)
+        snapshot = Snapshot(path)
+    os.utime(path)
+    with _open_lock:
+        for other in [k for k in _open if k[0] == user_id]:
+            del _open[other]
+        _open[key] = snapshot
+        while len(_open) > SNAPSHOT_OPEN_LIMIT:
+            _open.popitem(last=False)
+    return snapshot
+
+
+def _size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict(keep=None):
+    """Delete superseded versions, abandoned builds, then the least recently opened over budget.
+
+    Workers that still have a deleted snapshot mapped keep reading it; the
+    files are freed once the last one lets go.
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return
+    now = time.time()
+    current = []
+    for user_entry in os.scandir(SNAPSHOT_DIR):
+        if not user_entry.is_dir():
+            continue
+        versions = []
+        for entry in os.scandir(user_entry.path):
+            if not entry.is_dir():
+                continue
+            if '.build-' in entry.name:
+                if now - entry.stat().st_mtime > SNAPSHOT_STALE_BUILD_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.isdigit():
+                versions.append((int(entry.name), entry.path))
+        versions.sort()
+        for _, path in versions[:-1]:
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+        if versions:
+            path = versions[-1][1]
+            current.append((os.stat(path).st_mtime, _size(path), path))
+
+    total = sum(size for _, size, _ in current)
+    for _, size, path in sorted(current):
+        if total <= SNAPSHOT_MAX_BYTES:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
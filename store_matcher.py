@@ -0,0 +1,168 @@
+import time
+from collections import deque
+
+from sqlalchemy import event, select
+
+from extensions import db
+from models import Store
+
+# Other gunicorn workers can't see this process's invalidation events, so a
+# cached matcher is also rebuilt after this many seconds.
+MATCHER_TTL_SECONDS = 300
+
+# Distinct addresses memoized per matcher. A store's invoices nearly always
+# repeat the same few address strings, so this is normally a handful of keys.
+ADDRESS_CACHE_SIZE = 10000
+
+# Same diagnostic sample size the browser keeps in fileInfo.unassignedSamples
+UNASSIGNED_SAMPLE_LIMIT = 10
+
+# Order identifyStore in js/store-manager.js tries the seeded stores in: the
+# key order of STORE_CONFIG, where JavaScript puts integer-like keys ('280')
+# before the rest. Seeded into Store.priority.
+STORE_MATCH_ORDER = ('280', 'trussville', 'chelsea', '5points', 'valleydale', 'homewood')
+
+
+def load_store_patterns():
+    """Return [(store_id, [pattern, ...]), ...] from the Store rows, by priority"""
+    stores = db.session.execute(
+        select(Store.id, Store.address_patterns)
+        .order_by(Store.priority.is_(None), Store.priority, Store.id)
+    ).all()
+    return [
+        (store_id, [p.strip().upper() for p in (patterns or '').split(',') if p.strip()])
+        for store_id, patterns in stores
+    ]
+
+
+def unassigned_sample(record):
+    """Diagnostic summary of a row no store pattern matched"""
+    return {
+        'address': record.get('Address') or 'N/A',
+        'city': record.get('City') or 'N/A',
+        'customerName': record.get('Customer Name') or 'N/A',
+    }
+
+
+class StoreMatcher:
+    """Aho-Corasick automaton over every store's address patterns.
+
+    Matching scans an address once no matter how many stores or patterns
+    exist. When several patterns occur, the winner is the one listed first
+    (store priority, then pattern order), which matches the nested-loop
+    identifyStore in the browser.
+    """
+
+    def __init__(self, store_patterns):
+        self.store_ids = [store_id for store_id, _ in store_patterns]
+        self._goto = [{}]
+        self._fail = [0]
+        # Best (lowest) pattern priority recognised on reaching each state
+        self._out = [None]
+        self._cache = {}
+
+        priority = 0
+        for store_id, patterns in store_patterns:
+            for pattern in patterns:
+                self._add(pattern, (priority, store_id))
+                priority += 1
+        self._link()
+
+    def _add(self, pattern, hit):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+                self._goto[state][ch] = nxt
+            state = nxt
+        if self._out[state] is None or hit < self._out[state]:
+            self._out[state] = hit
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                inherited = self._out[self._fail[nxt]]
+                if inherited is not None and (self._out[nxt] is None or inherited < self._out[nxt]):
+                    self._out[nxt] = inherited
+
+    def _search(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        best = None
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            hit = out[state]
+            if hit is not None and (best is None or hit < best):
+                best = hit
+        return best[1] if best else None
+
+    def match(self, address):
+        """Return the store_id for one address, or None"""
+        key = (address or '').upper()
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        store_id = self._search(key)
+        if len(self._cache) >= ADDRESS_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = store_id
+        return store_id
+
+    def classify(self, records):
+        """Assign a batch of CSV/JSON records to stores by their Address.
+
+        Returns {'assignments': [store_id or None, ...], 'unassigned_records': n,
+        'unassigned_samples': [...]} with assignments aligned to records.
+        """
+        assignments = []
+        unassigned_samples = []
+        unassigned_records = 0
+        for record in records:
+            store_id = self.match(record.get('Address'))
+            assignments.append(store_id)
+            if store_id is None:
+                unassigned_records += 1
+                if len(unassigned_samples) < UNASSIGNED_SAMPLE_LIMIT:
+                    unassigned_samples.append(unassigned_sample(record))
+        return {
+            'assignments': assignments,
+            'unassigned_records': unassigned_records,
+            'unassigned_samples': unassigned_samples,
+        }
+
+
+_matcher = None
+_matcher_built_at = 0.0
+
+
+def get_store_matcher():
+    """Return this process's compiled matcher, building it on first use"""
+    global _matcher, _matcher_built_at
+    if _matcher is None or time.monotonic() - _matcher_built_at > MATCHER_TTL_SECONDS:
+        _matcher = StoreMatcher(load_store_patterns())
+        _matcher_built_at = time.monotonic()
+    return _matcher
+
+
+def invalidate_store_matcher(*args):
+    """Drop the cached matcher so the next lookup recompiles it"""
+    global _matcher
+    _matcher = None
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Store, _event, invalidate_store_matcher)
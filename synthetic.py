@@ -0,0 +1,183 @@
+import csv
+import io
+import os
+import random
+from datetime import date, timedelta
+
+SAMPLE_EXPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'CustomerFirstInvoiceExport_20250628.csv')
+
+# Delivery address per seeded store; each contains one of the store's address patterns
+STORE_ADDRESSES = {
+    'trussville': ('7270 GADSDEN HWY', 'TRUSSVILLE', '35173'),
+    'chelsea': ('50 CHELSEA RD', 'BIRMINGHAM', '35244'),
+    '5points': ('1024 20TH ST S', 'BIRMINGHAM', '35205'),
+    'valleydale': ('2657 VALLEYDALE RD', 'BIRMINGHAM', '35244'),
+    'homewood': ('803 GREEN SPRINGS HWY', 'HOMEWOOD', '35209'),
+    '280': ('1401 DOUG BAKER BLVD', 'BIRMINGHAM', '35242'),
+}
+
+# Columns that describe a product rather than an invoice line
+PRODUCT_COLUMNS = (
+    'Vendor #', 'Manufacturer Name', 'Manufacturer Product #', 'Category/Class', 'GTIN',
+    'Product #', 'Product Description', 'Brand', 'Pack Size', 'UOM',
+)
+
+# Deliveries on Monday, Wednesday and Friday
+DELIVERY_WEEKDAYS = (0, 2, 4)
+
+# Weekly price drift and the odds and size of a one-off price spike
+PRICE_DRIFT = 0.01
+SPIKE_PROBABILITY = 0.02
+SPIKE_FACTOR = 1.35
+
+# Rows a duplicate is drawn from: the tail of what has been generated, as
+# when overlapping date ranges are exported twice
+DUPLICATE_WINDOW = 5000
+
+
+def load_catalog(path=SAMPLE_EXPORT):
+    """(header, products) from a PFG export; products carry a base unit price"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        header = reader.fieldnames
+        products = {}
+        for row in reader:
+            product = {c: row[c] for c in PRODUCT_COLUMNS}
+            product['price'] = float(row['Unit Price'] or 0) or float(row['Ext. Price'] or 0) or 1.0
+            products.setdefault(row['Product #'], product)
+    return header, list(products.values())
+
+
+def expand_catalog(products, size, rng):
+    """Grow the catalogue to size products with renumbered, repriced variants"""
+    catalog = list(products)
+    variant = 1
+    while len(catalog) < size:
+        for base in products:
+            if len(catalog) >= size:
+                break
+            product = dict(base)
+            product['Product #'] = f"{base['Product #']}{variant:03d}"
+            product['GTIN'] = f"{base['GTIN']}{variant:03d}" if base['GTIN'] else ''
+            product['Product Description'] = f"{base['Product Description']} V{variant}"
+            product['price'] = round(base['price'] * rng.uniform(0.7, 1.3), 4)
+            catalog.append(product)
+        variant += 1
+    return catalog
+
+
+def delivery_days(count, end):
+    """The last count delivery days up to end, oldest first"""
+    days = []
+    day = end
+    while len(days) < count:
+        if day.weekday() in DELIVERY_WEEKDAYS:
+            days.append(day)
+        day -= timedelta(days=1)
+    return days[::-1]
+
+
+def generate_rows(n_rows, duplicate_rate=0.0, seed=0, years=3, end=date(2025, 6, 27)):
+    """Yield n_rows PFG-shaped export rows (dicts keyed by the sample header).
+
+    Invoices go to the six stores on every delivery day of the last years
+    years; the lines per invoice (and the catalogue size) grow with n_rows so
+    the rows always cover the whole span. Prices follow a weekly random walk with
+    occasional spikes. A duplicate_rate share of rows repeat an earlier row,
+    hitting the dedup key on upload. The same arguments always produce the
+    same rows.
+    """
+    rng = random.Random(seed)
+    header, base_products = load_catalog()
+    days = delivery_days(len(DELIVERY_WEEKDAYS) * 52 * years, end)
+    invoices = len(days) * len(STORE_ADDRESSES)
+    unique_rows = n_rows - int(n_rows * duplicate_rate)
+    lines = -(-unique_rows // invoices)
+    catalog = expand_catalog(base_products, max(len(base_products), lines * 2), rng)
+    prices = [p['price'] for p in catalog]
+
+    duplicates = n_rows - unique_rows
+    unique = 0
+    emitted_duplicates = 0
+    recent = []
+    invoice_number = 7000000
+    invoice_index = 0
+    week = None
+    for day in days:
+        if day.isocalendar()[1] != week:
+            week = day.isocalendar()[1]
+            prices = [max(0.05, p * (1 + rng.gauss(0, PRICE_DRIFT))) for p in prices]
+        for store_id, (address, city, zip_code) in STORE_ADDRESSES.items():
+            # Spread the lines evenly over every invoice in the span
+            invoice_index += 1
+            count = unique_rows * invoice_index // invoices - unique
+            if count <= 0:
+                continue
+            invoice_number += 1
+            chosen = rng.sample(range(len(catalog)), count)
+            invoice = {
+                'Customer OpCo': 'Performance Foodservice Nashville',
+                'Customer #': '55090180',
+                'Customer Name': "SANPEGGIO'S PIZZA",
+                'Address': address,
+                'City': city,
+                'State': 'AL',
+                'Zip Code': zip_code,
+                'Invoice Date': f'{day.month}/{day.day}/{day.year}',
+                'Invoice Number': str(invoice_number),
+                'Invoice Order Number': str(invoice_number - 900000),
+                'Invoice Type': 'Invoice',
+                'Route Number': f'4B{rng.randint(10, 99)}',
+                'Route Stop Number': str(rng.randint(1, 20)),
+            }
+            rows = []
+            for sequence, index in enumerate(chosen, start=1):
+                product = catalog[index]
+                price = prices[index] * (SPIKE_FACTOR if rng.random() < SPIKE_PROBABILITY else 1)
+                qty = rng.choices((1, 2, 3, 4, 6), weights=(50, 25, 12, 8, 5))[0]
+                row = dict.fromkeys(header, '')
+                row.update(invoice)
+                row.update({c: product[c] for c in PRODUCT_COLUMNS})
+                row.update({
+                    'Printed Sequence': str(sequence),
+                    'Net Price': f'{price:.4f}',
+                    'Qty Ordered': str(qty),
+                    'Qty Shipped': str(qty),
+                    'Unit Price': f'{price:.4f}',
+                    'Ext. Price': f'{price * qty:.2f}',
+                })
+                rows.append(row)
+            subtotal = sum(float(r['Ext. Price']) for r in rows)
+            shipped = sum(int(r['Qty Shipped']) for r in rows)
+            for row in rows:
+                row.update({
+                    'Invoice Subtotal': f'{subtotal:.2f}',
+                    'Invoice Discount': '0.00',
+                    'Invoice Charges Fees': '6.50',
+                    'Invoice Total Tax': '0.00',
+                    'Invoice Total': f'{subtotal + 6.5:.2f}',
+                    'Total Qty Ordered': str(shipped),
+                    'Total Qty Shipped': str(shipped),
+                })
+
+            for row in rows:
+                yield row
+                if len(recent) < DUPLICATE_WINDOW:
+                    recent.append(row)
+                else:
+                    recent[unique % DUPLICATE_WINDOW] = row
+                unique += 1
+                # Spread the duplicates evenly through the file
+                while emitted_duplicates < unique * duplicates // unique_rows:
+                    yield dict(rng.choice(recent))
+                    emitted_duplicates += 1
+
+
+def export_csv(n_rows, duplicate_rate=0.0, seed=0, years=3):
+    """A generated export as CSV bytes, header first like the PFG download"""
+    header, _ = load_catalog()
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=header)
+    writer.writeheader()
+    writer.writerows(generate_rows(n_rows, duplicate_rate, seed, years))
+    return buffer.getvalue().encode('utf-8')
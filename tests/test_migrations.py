@@ -0,0 +1,52 @@
+import pytest
+from flask import Flask
+from sqlalchemy import inspect, text
+
+from extensions import db
+from migrations import migrate_invoice_record_types
+
+
+@pytest.fixture
+def legacy_db():
+    """App context on an in-memory SQLite invoice_records with text dates and float prices"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.session.execute(text(
+            "CREATE TABLE invoice_records (id INTEGER PRIMARY KEY, invoice_date VARCHAR(20), "
+            "unit_price FLOAT, extended_price FLOAT)"))
+        db.session.commit()
+        yield db
+
+
+def _insert(session, *dates):
+    for i, value in enumerate(dates, start=1):
+        session.execute(text("INSERT INTO invoice_records VALUES (:id, :date, 1.5, 3.0)"),
+                        {'id': i, 'date': value})
+    session.commit()
+
+
+def _columns():
+    return {c['name'] for c in inspect(db.session.get_bind()).get_columns('invoice_records')}
+
+
+def test_legacy_dates_convert_and_old_column_is_dropped(legacy_db):
+    _insert(legacy_db.session, '6/26/2025', '2025-06-27', None, '')
+    migrate_invoice_record_types(batch_size=2)
+
+    dates = legacy_db.session.execute(text("SELECT invoice_date FROM invoice_records ORDER BY id")).scalars()
+    assert list(dates) == ['2025-06-26', '2025-06-27', None, None]
+    assert 'invoice_date__old' not in _columns()
+
+
+def test_unparseable_legacy_date_is_reported_and_kept(legacy_db, capsys):
+    _insert(legacy_db.session, '6/26/2025', 'not/a/date', '26.06.2025')
+    migrate_invoice_record_types(batch_size=2)
+
+    rows = legacy_db.session.execute(text(
+        "SELECT invoice_date, invoice_date__old FROM invoice_records ORDER BY id")).all()
+    assert [tuple(row) for row in rows] == [
+        ('2025-06-26', '6/26/2025'), (None, 'not/a/date'), (None, '26.06.2025')]
+    assert '2 invoice_records.invoice_date values could not be converted' in capsys.readouterr().out
+    assert 'unit_price__old' not in _columns()
@@ -0,0 +1,56 @@
+import math
+import random
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+from volatility import detect_spikes, rolling_stats
+
+
+def window_reference(days, categories, prices, window_days):
+    """(mean, variance, price - mean) per row in exact arithmetic, each window filtered on its own"""
+    result = []
+    for day, category, price in zip(days, categories, prices):
+        window = [Fraction(p) for d, c, p in zip(days, categories, prices)
+                  if c == category and day - window_days <= d <= day]
+        mean = sum(window) / len(window)
+        variance = sum((p - mean) ** 2 for p in window) / len(window)
+        result.append((mean, variance, Fraction(price) - mean))
+    return result
+
+
+@pytest.mark.parametrize('window_days', [0, 7, 30, 90])
+def test_rolling_stats_match_direct_windows(window_days):
+    rng = random.Random(window_days)
+    n = 1500
+    days = [rng.randrange(300) for _ in range(n)]
+    categories = [rng.randrange(4) for _ in range(n)]
+    prices = [rng.choice([0.37, 0.37, 0.37, 12.5, 41.04, 0.0]) for _ in range(n)]
+
+    mean, std, cov, z = rolling_stats(days, categories, prices, window_days)
+    reference = window_reference(days, categories, prices, window_days)
+
+    assert np.allclose(mean, [float(m) for m, v, d in reference], rtol=0, atol=1e-9)
+    assert np.allclose(std, [math.sqrt(v) for m, v, d in reference], rtol=0, atol=1e-9)
+    ref_z = [float(d) / math.sqrt(v) if m > 0 and v else 0.0 for m, v, d in reference]
+    assert np.allclose(z, ref_z, rtol=0, atol=1e-9)
+    for threshold in (1, 2, 3):
+        # |z| > threshold, decided exactly
+        spikes = [m > 0 and d * d > threshold * threshold * v for m, v, d in reference]
+        assert detect_spikes(z, threshold)[0].tolist() == spikes
+
+
+def test_spike_threshold_tie_is_not_a_spike():
+    # Four equal prices and one outlier put the outlier at exactly z = 2
+    z = rolling_stats([0] * 5, [0] * 5, [0.37] * 4 + [41.04], 30)[3]
+    assert z[4] == 2.0
+    is_spike, direction = detect_spikes(z, 2.0)
+    assert not is_spike.any()
+    assert (direction == '').all()
+
+
+def test_window_without_spread_has_zero_std():
+    mean, std, cov, z = rolling_stats([0, 1, 2], [0, 0, 0], [0.1, 0.1, 0.1], 30)
+    assert (std == 0).all()
+    assert (z == 0).all()
@@ -0,0 +1,405 @@
+import csv
+import gzip
+import io
+import json
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import delete, insert, or_, select, update
+
+from extensions import db
+
+# Input rows inserted per committed batch; the job's checkpoint advances with
+# each commit, so a restarted job redoes at most one batch
+JOB_BATCH_SIZE = 5000
+
+# Seconds an idle worker waits before looking for queued jobs again
+JOB_POLL_SECONDS = 5
+
+# A running job whose heartbeat is older than this is assumed to belong to a
+# dead worker and is picked up again from its checkpoint
+JOB_STALE_SECONDS = 300
+
+# Bytes read from the request per iteration while spooling a CSV body
+SPOOL_CHUNK_BYTES = 64 * 1024
+
+# Size of each stored piece of a job's gzip'd input (an UploadJobChunk row)
+PAYLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Records serialized per write while spooling a records job
+RECORDS_SPOOL_BATCH = 1000
+
+# Set UPLOAD_WORKER=0 on web processes when a separate `flask upload-worker` runs
+IN_PROCESS_WORKER = os.environ.get('UPLOAD_WORKER', '1') != '0'
+
+_wakeup = threading.Event()
+_worker_lock = threading.Lock()
+_worker_pid = None
+
+
+class _PayloadWriter:
+    """File-like sink that stores a job's input as numbered UploadJobChunk rows"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.seq = 0
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= PAYLOAD_CHUNK_BYTES:
+            self._insert(bytes(self.buffer[:PAYLOAD_CHUNK_BYTES]))
+            del self.buffer[:PAYLOAD_CHUNK_BYTES]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self._insert(bytes(self.buffer))
+            self.buffer.clear()
+
+    def _insert(self, data):
+        from models import UploadJobChunk
+
+        db.session.execute(insert(UploadJobChunk), {'job_id': self.job_id, 'seq': self.seq, 'data': data})
+        self.seq += 1
+
+
+class _PayloadReader(io.RawIOBase):
+    """Reads a job's stored input back one UploadJobChunk row at a time"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.seq = 0
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        from models import UploadJobChunk
+
+        while self.offset >= len(self.chunk):
+            data = db.session.execute(
+                select(UploadJobChunk.data)
+                .where(UploadJobChunk.job_id == self.job_id, UploadJobChunk.seq == self.seq)
+            ).scalar()
+            if data is None:
+                return 0
+            self.chunk, self.offset = data, 0
+            self.seq += 1
+        n = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+
+def _store_payload(job_id, pieces, gzipped=False):
+    """Write byte pieces to the job's chunk rows, gzip'ing them unless they already are"""
+    writer = _PayloadWriter(job_id)
+    if gzipped:
+        for piece in pieces:
+            writer.write(piece)
+    else:
+        with gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=6, mtime=0) as compressed:
+            for piece in pieces:
+                compressed.write(piece)
+    writer.close()
+
+
+def _discard_payload(job_id):
+    from models import UploadJobChunk
+
+    db.session.execute(delete(UploadJobChunk).where(UploadJobChunk.job_id == job_id))
+
+
+def enqueue_csv(user_id, stream, filename, file_size, gzipped=False, replaces=None):
+    """Queue a raw PFG export for ingest (caller commits).
+
+    The body is streamed into the job's chunk rows, gzip'd unless it already
+    is, so memory use does not grow with the file; the app's
+    MAX_CONTENT_LENGTH bounds its size. Parsing, store assignment and inserts
+    all happen in the worker. With replaces (an Upload) only rows for that
+    upload's store are ingested (others count as rejected), and the worker
+    deletes the old upload once the whole new file has been read and found
+    to contain some, so rows present in both are re-inserted rather than
+    skipped as duplicates. A file that cannot be read or has no rows for the
+    store fails the job and leaves the upload as it was.
+    """
+    from models import UploadJob
+
+    job = UploadJob(
+        user_id=user_id,
+        kind='csv',
+        store_id=replaces.store_id if replaces is not None else None,
+        filename=filename,
+        file_size=file_size,
+        progress=json.dumps({'replaces_upload_id': replaces.id}) if replaces is not None else None,
+    )
+    db.session.add(job)
+    db.session.flush()
+    _store_payload(job.id, iter(lambda: stream.read(SPOOL_CHUNK_BYTES), b''), gzipped)
+    return job
+
+
+def enqueue_records(user_id, store_id, filename, file_size, records):
+    """Queue already-parsed records for one store (caller commits).
+
+    They are stored as JSON lines, so the worker decodes one record at a time.
+    """
+    from models import UploadJob
+
+    job = UploadJob(
+        user_id=user_id,
+        kind='records',
+        store_id=store_id,
+        filename=filename,
+        file_size=file_size,
+        total_rows=len(records),
+    )
+    db.session.add(job)
+    db.session.flush()
+    lines = (''.join(json.dumps(r) + '\n' for r in records[i:i + RECORDS_SPOOL_BATCH]).encode('utf-8')
+             for i in range(0, len(records), RECORDS_SPOOL_BATCH))
+    _store_payload(job.id, lines)
+    return job
+
+
+def job_status(job):
+    """Progress payload for /api/uploads/<id>/status"""
+    progress = json.loads(job.progress or '{}')
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'filename': job.filename,
+        'total_rows': job.total_rows,
+        'rows_processed': job.rows_processed,
+        'new_records': job.new_records,
+        'duplicate_records': job.duplicate_records,
+        'error_count': job.error_count,
+        'rejected_records': progress.get('rejected_records', 0),
+        'error': job.error,
+        'stores': list(progress.get('stores', {}).values()),
+        'unassigned_samples': progress.get('unassigned_samples', []),
+        'replaced': progress.get('replaced'),
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def claim_job(worker):
+    """Take the oldest queued (or abandoned) job, or None when there is none.
+
+    The claim is a conditional UPDATE on the status and heartbeat the job was
+    read with, so when several workers race for a job exactly one wins.
+    """
+    from models import UploadJob
+
+    stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    candidates = db.session.execute(
+        select(UploadJob.id, UploadJob.status, UploadJob.heartbeat_at)
+        .where(or_(
+            UploadJob.status == 'queued',
+            (UploadJob.status == 'running') & (UploadJob.heartbeat_at < stale),
+        ))
+        .order_by(UploadJob.id)
+        .limit(10)
+    ).all()
+    for job_id, status, heartbeat in candidates:
+        now = datetime.utcnow()
+        stmt = update(UploadJob).where(UploadJob.id == job_id, UploadJob.status == status)
+        if heartbeat is None:
+            stmt = stmt.where(UploadJob.heartbeat_at.is_(None))
+        else:
+            stmt = stmt.where(UploadJob.heartbeat_at == heartbeat)
+        claimed = db.session.execute(stmt.values(status='running', worker=worker, heartbeat_at=now))
+        db.session.commit()
+        if claimed.rowcount == 1:
+            job = db.session.get(UploadJob, job_id)
+            if job.started_at is None:
+                job.started_at = now
+                db.session.commit()
+            return job
+    return None
+
+
+def _input_rows(job):
+    """The job's input records, from the first one not yet checkpointed"""
+    from ingest import open_csv_stream
+
+    stream = io.BufferedReader(_PayloadReader(job.id), SPOOL_CHUNK_BYTES)
+    if job.kind == 'csv':
+        rows = open_csv_stream(stream, gzipped=True)
+    else:
+        lines = io.TextIOWrapper(gzip.GzipFile(fileobj=stream, mode='rb'), encoding='utf-8')
+        rows = (json.loads(line) for line in lines)
+    return islice(rows, job.rows_processed, None)
+
+
+def _replacement_rows(job, worker, matcher):
+    """Rows of a replacement file that belong to the replaced upload's store.
+
+    Reads and classifies the whole file before anything is deleted, so an
+    unreadable file, or one for another store, leaves the old upload intact.
+    """
+    matching = 0
+    rows = _input_rows(job)
+    while True:
+        chunk = list(islice(rows, JOB_BATCH_SIZE))
+        if not chunk:
+            return matching
+        matching += matcher.classify(chunk)['assignments'].count(job.store_id)
+        _checkpoint(job, worker)
+
+
+def _checkpoint(job, worker, **values):
+    """Save job progress and commit, provided this worker still owns the job"""
+    from models import UploadJob
+
+    saved = db.session.execute(
+        update(UploadJob).where(UploadJob.id == job.id, UploadJob.worker == worker)
+        .values(heartbeat_at=datetime.utcnow(), **values)
+    )
+    if saved.rowcount != 1:
+        raise RuntimeError(f"Upload job {job.id} was taken over by another worker")
+    db.session.commit()
+
+
+def run_job(job, worker):
+    """Ingest a claimed job batch by batch, committing a checkpoint with each batch"""
+    from ingest import delete_upload, ingest_chunk
+    from models import Upload
+    from store_matcher import UNASSIGNED_SAMPLE_LIMIT, get_store_matcher
+
+    print(f"Upload job {job.id}: {job.kind} {job.filename} from row {job.rows_processed}")
+    progress = json.loads(job.progress or '{}')
+    matcher = get_store_matcher() if job.kind == 'csv' else None
+    if progress.get('replaces_upload_id') and 'replaced' not in progress:
+        if not _replacement_rows(job, worker, matcher):
+            _discard_payload(job.id)
+            _checkpoint(job, worker, status='failed', finished_at=datetime.utcnow(),
+                        error=f'No rows in {job.filename} belong to store {job.store_id}; the upload was not replaced.')
+            print(f"Upload job {job.id}: failed, no rows for store {job.store_id}")
+            return
+        # Deleting is idempotent, so a job restarted midway simply finishes it
+        old = db.session.get(Upload, progress['replaces_upload_id'])
+        progress['replaced'] = delete_upload(old) if old is not None else None
+        _checkpoint(job, worker, progress=json.dumps(progress))
+    stores = progress.setdefault('stores', {})
+    samples = progress.setdefault('unassigned_samples', [])
+    rows_processed = job.rows_processed
+    error_count = job.error_count
+
+    rows = _input_rows(job)
+    while True:
+        chunk = list(islice(rows, JOB_BATCH_SIZE))
+        if not chunk:
+            break
+        if matcher is not None:
+            classified = matcher.classify(chunk)
+            store_ids = classified['assignments']
+            error_count += classified['unassigned_records']
+            samples.extend(classified['unassigned_samples'][:UNASSIGNED_SAMPLE_LIMIT - len(samples)])
+            if job.store_id is not None:
+                # A replacement only takes the replaced upload's place; rows
+                # for other stores are reported as rejected, not ingested
+                rejected = sum(1 for s in store_ids if s is not None and s != job.store_id)
+                progress['rejected_records'] = progress.get('rejected_records', 0) + rejected
+                store_ids = [s if s == job.store_id else None for s in store_ids]
+        else:
+            store_ids = [job.store_id] * len(chunk)
+
+        ingest_chunk(chunk, store_ids, job.user_id, job.filename, job.file_size, stores)
+        rows_processed += len(chunk)
+        _checkpoint(
+            job, worker,
+            rows_processed=rows_processed,
+            error_count=error_count,
+            new_records=sum(s['new_records'] for s in stores.values()),
+            duplicate_records=sum(s['duplicate_records'] for s in stores.values()),
+            progress=json.dumps(progress),
+        )
+
+    if job.kind == 'csv' and not stores:
+        status = 'failed'
+        error = f'Could not determine store for file: {job.filename}. No matching addresses found.'
+    else:
+        status, error = 'done', None
+    _discard_payload(job.id)
+    _checkpoint(job, worker, status=status, error=error, total_rows=rows_processed,
+                finished_at=datetime.utcnow())
+    print(f"Upload job {job.id}: {status}, {job.new_records} new, {job.duplicate_records} duplicates")
+
+
+def _fail(job_id, worker, error):
+    """Mark a job failed, unless another worker has since taken it over"""
+    from models import UploadJob
+
+    db.session.rollback()
+    failed = db.session.execute(
+        update(UploadJob).where(UploadJob.id == job_id, UploadJob.worker == worker)
+        .values(status='failed', error=error, finished_at=datetime.utcnow())
+    )
+    if failed.rowcount == 1:
+        _discard_payload(job_id)
+    db.session.commit()
+
+
+def process_jobs(worker):
+    """Run queued jobs until none are left; returns how many were run"""
+    count = 0
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            return count
+        count += 1
+        job_id = job.id
+        try:
+            run_job(job, worker)
+        except (UnicodeDecodeError, OSError, csv.Error, json.JSONDecodeError) as e:
+            print(f"Upload job {job_id} failed: {e}")
+            _fail(job_id, worker, f'Could not read upload: {e}')
+        except Exception as e:
+            traceback.print_exc()
+            _fail(job_id, worker, str(e))
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def work_forever(app):
+    """Worker loop: drain the queue, then sleep until woken or the poll interval passes"""
+    worker = worker_name()
+    while True:
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                process_jobs(worker)
+        except Exception:
+            traceback.print_exc()
+        _wakeup.wait(JOB_POLL_SECONDS)
+
+
+def ensure_worker(app):
+    """Start this process's background worker thread once, and wake it.
+
+    Started lazily from requests rather than at import so each gunicorn
+    worker gets its own thread after forking.
+    """
+    global _worker_pid
+    if not IN_PROCESS_WORKER:
+        return
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            threading.Thread(target=work_forever, args=(app,), name='upload-worker', daemon=True).start()
+            _worker_pid = os.getpid()
+    _wakeup.set()
@@ -0,0 +1,241 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+EPOCH = date(1970, 1, 1)
+
+# Longest trailing window the reports accept, in days
+MAX_WINDOW_DAYS = 3650
+
+# Largest relative error in a window's variance taken from prefix sums;
+# windows that cannot be shown to be within it are recomputed directly
+ROLLING_TOLERANCE = 1e-12
+
+# Decimal places z is compared to the spike threshold at
+Z_DECIMALS = 9
+
+# Window values gathered at once while recomputing windows directly
+ROLLING_BLOCK_VALUES = 1 << 20
+
+
+def rolling_stats(days, categories, prices, window_days=30):
+    """Rolling price statistics per category over a trailing date window.
+
+    days are integer day numbers, categories integer codes and prices floats
+    (parallel arrays, any order). For each row the window is every row of the
+    same category dated within [day - window_days, day], same-day rows
+    included, which is what rollingStats in js/parser.js computes with a full
+    filter per row. Here it is one sort plus extended-precision prefix sums;
+    windows whose prefix-sum variance is not provably accurate (little
+    spread against the category's prices) are recomputed two-pass from
+    deviations about their own mean, as the browser does.
+
+    Returns (mean, std, cov, z) arrays aligned with the input. std is the
+    population standard deviation. z is 0 where the window has no spread;
+    the browser produces NaN there, which detectSpikes treats as 0.
+    """
+    days = np.asarray(days, dtype=np.int64)
+    categories = np.asarray(categories, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    n = len(prices)
+    if n == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty
+
+    # Categories are spread further apart than the date span plus the window,
+    # so one sorted key array holds every category without a window
+    # reaching into a neighbour
+    low = days.min()
+    stride = int(days.max() - low) + window_days + 1
+    key = categories * stride + (days - low)
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    sorted_prices = prices[order]
+    sorted_categories = categories[order]
+
+    # Windows are contiguous runs of the sorted rows, in the browser's
+    # date-then-input order
+    left = np.searchsorted(key, key - window_days, side='left')
+    right = np.searchsorted(key, key, side='right')
+    size = right - left
+
+    # Shift by each category's mean before summing squares so the variance
+    # is not swamped by cancellation; variance is unchanged by the shift.
+    counts = np.bincount(sorted_categories)
+    centers = np.bincount(sorted_categories, weights=sorted_prices) / np.maximum(counts, 1)
+    shifted = (sorted_prices - centers[sorted_categories]).astype(np.longdouble)
+    s1, steps = _running_sum(shifted)
+    a1 = _running_sum(np.abs(shifted))[0]
+    s2 = _running_sum(shifted * shifted)[0]
+
+    shifted_mean = (s1[right] - s1[left]) / size
+    variance = (s2[right] - s2[left]) / size - shifted_mean ** 2
+    mean = (shifted_mean + centers[sorted_categories]).astype(np.float64)
+
+    # Each prefix sum is off by at most steps * eps * (sum of |terms|), which
+    # bounds the error of each window's mean and variance
+    bound = steps * np.finfo(np.longdouble).eps
+    mean_error = bound * (a1[right] + a1[left]) / size
+    variance_error = (bound * (s2[right] + s2[left]) / size
+                      + (2 * np.abs(shifted_mean) + mean_error) * mean_error)
+    inexact = np.flatnonzero((variance_error > ROLLING_TOLERANCE * variance)
+                             | (mean_error ** 2 > ROLLING_TOLERANCE * variance))
+    variance = np.maximum(variance, 0).astype(np.float64)
+    if len(inexact):
+        mean[inexact], variance[inexact] = _window_moments(sorted_prices, left[inexact], size[inexact])
+    std = np.sqrt(variance)
+
+    positive = mean > 0
+    cov = np.where(positive, std / np.where(positive, mean, 1.0), 0.0)
+    spread = positive & (std > 0)
+    z = np.where(spread, (sorted_prices - mean) / np.where(spread, std, 1.0), 0.0)
+
+    out = [np.empty(n) for _ in range(4)]
+    for target, values in zip(out, (mean, std, cov, z)):
+        target[order] = values
+    return tuple(out)
+
+
+def _running_sum(values):
+    """(prefix sums of values with a leading 0, roundings behind each sum).
+
+    Summed within blocks of about sqrt(n) values and then across blocks, so
+    each prefix sum collects about 2 * sqrt(n) roundings rather than n.
+    """
+    n = len(values)
+    block = max(int(np.sqrt(n)), 1)
+    grid = np.concatenate((values, np.zeros(-n % block, values.dtype))).reshape(-1, block)
+    local = np.cumsum(grid, axis=1)
+    offsets = np.concatenate(([0], np.cumsum(local[:-1, -1])))
+    sums = np.concatenate(([0], (local + offsets[:, None]).ravel()[:n]))
+    return sums, block + len(offsets) + 1
+
+
+def _window_moments(values, starts, sizes):
+    """Mean and population variance of values[start:start + size] for each window.
+
+    Variance is summed from deviations about the window's own mean, and is
+    exactly 0 for a window of one repeated value. Windows
+    are gathered a block at a time, about ROLLING_BLOCK_VALUES values each.
+    """
+    n = len(starts)
+    mean = np.empty(n)
+    variance = np.empty(n)
+    ends = np.cumsum(sizes)
+    first = 0
+    while first < n:
+        base = ends[first] - sizes[first]
+        last = max(int(np.searchsorted(ends, base + ROLLING_BLOCK_VALUES, side='right')), first + 1)
+        lens = sizes[first:last]
+        offsets = ends[first:last] - lens - base
+        # Position j of the block belongs to window i at values[starts[i] + j - offsets[i]]
+        gathered = values[np.arange(offsets[-1] + lens[-1]) + np.repeat(starts[first:last] - offsets, lens)]
+        block_mean = np.add.reduceat(gathered, offsets) / lens
+        deviations = gathered - np.repeat(block_mean, lens)
+        # A window of one repeated price has no spread, whatever its mean rounds to
+        flat = np.maximum.reduceat(gathered, offsets) == np.minimum.reduceat(gathered, offsets)
+        mean[first:last] = block_mean
+        variance[first:last] = np.where(flat, 0.0, np.add.reduceat(deviations * deviations, offsets) / lens)
+        first = last
+    return mean, variance
+
+
+def detect_spikes(z, z_threshold=2.0):
+    """Spike flags and direction ('up'/'down'/None), matching detectSpikes.
+
+    z is compared to the threshold at Z_DECIMALS places, so a window whose
+    exact z equals the threshold is not flagged on a last-bit rounding error.
+    """
+    z = np.round(np.asarray(z, dtype=np.float64), Z_DECIMALS)
+    is_spike = np.abs(z) > z_threshold
+    direction = np.where(z > z_threshold, 'up', np.where(z < -z_threshold, 'down', ''))
+    return is_spike, direction
+
+
+def _scan(user_id, filters):
+    """(snapshot, row indexes, days, category codes, unit prices) of dated rows under filters"""
+    from snapshots import user_snapshot
+
+    snapshot = user_snapshot(user_id)
+    rows = np.flatnonzero(snapshot.mask(filters, dated=True))
+    return (snapshot, rows, snapshot.day[rows].astype(np.int64),
+            snapshot.category[rows].astype(np.int64), snapshot.unit_price[rows])
+
+
+def row_stats(user_id, filters):
+    """(ids, mean, std, cov, z, is_spike) per dated row under filters, ascending by id"""
+    snapshot, rows, days, categories, prices = _scan(user_id, filters)
+    if not len(rows):
+        return (np.empty(0, dtype=np.int64),) + tuple(np.empty(0) for _ in range(4)) + (np.empty(0, dtype=bool),)
+    mean, std, cov, z = rolling_stats(days, categories, prices, filters['window'])
+    is_spike = detect_spikes(z, filters['z'])[0]
+    ids = snapshot.id[rows]
+    order = np.argsort(ids)
+    return tuple(column[order] for column in (ids, mean, std, cov, z, is_spike))
+
+
+def spike_ids(user_id, filters):
+    """Ids of the rows volatility_report flags as spikes under the same filters"""
+    ids, *_, is_spike = row_stats(user_id, filters)
+    return set(ids[is_spike].tolist())
+
+
+def volatility_report(user_id, filters):
+    """Per-row rolling stats and spike flags plus a per-category summary.
+
+    Scans the user's memory-mapped snapshot rather than the database.
+    """
+    snapshot, rows, days, category_codes, prices = _scan(user_id, filters)
+    present, categories = np.unique(category_codes, return_inverse=True)
+    category_names = [snapshot.labels['category'][code] for code in present.tolist()]
+
+    mean, std, cov, z = rolling_stats(days, categories, prices, filters['window'])
+    is_spike, direction = detect_spikes(z, filters['z'])
+
+    labels = snapshot.labels
+    ids = snapshot.id[rows].tolist()
+    products = snapshot.product[rows].tolist()
+    vendors = snapshot.vendor[rows].tolist()
+    stores = snapshot.store[rows].tolist()
+
+    records = []
+    for i in np.argsort(days, kind='stable'):
+        if filters['spikes_only'] and not is_spike[i]:
+            continue
+        records.append({
+            'id': ids[i],
+            'invoiceDate': (EPOCH + timedelta(days=int(days[i]))).isoformat(),
+            'category': category_names[categories[i]],
+            'productDescription': labels['product'][products[i]],
+            'vendor': labels['vendor'][vendors[i]],
+            'storeId': labels['store'][stores[i]],
+            'unitPrice': float(prices[i]),
+            'rollingMean': float(mean[i]),
+            'rollingStdDev': float(std[i]),
+            'volatility': float(cov[i]),
+            'zScore': float(z[i]),
+            'isSpike': bool(is_spike[i]),
+            'spikeDirection': direction[i] or None,
+        })
+
+    counts = np.bincount(categories, minlength=len(category_names))
+    cov_sums = np.bincount(categories, weights=cov, minlength=len(category_names))
+    spike_counts = np.bincount(categories, weights=is_spike, minlength=len(category_names))
+    cov_max = np.zeros(len(category_names))
+    np.maximum.at(cov_max, categories, cov)
+    summary = {
+        category: {
+            'records': int(counts[code]),
+            'avgVolatility': float(cov_sums[code] / counts[code]),
+            'maxVolatility': float(cov_max[code]),
+            'spikeCount': int(spike_counts[code]),
+        } for code, category in enumerate(category_names)
+    }
+
+    return {
+        'window': filters['window'],
+        'zThreshold': filters['z'],
+        'spikeCount': int(is_spike.sum()),
+        'categories': summary,
+        'records': records,
+    }